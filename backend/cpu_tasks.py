@@ -0,0 +1,27 @@
+"""CPU-bound helpers run in the offload process pool.
+
+Kept free of app imports so spawned worker processes can import this module
+without loading server.py (and its Mongo client, routes and config).
+"""
+import base64
+import hashlib
+
+
+def b64encode_text(data: bytes) -> str:
+    return base64.b64encode(data).decode('utf-8')
+
+
+def b64decode_text(data: str) -> bytes:
+    return base64.b64decode(data)
+
+
+def sha256_hex(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def pattern_matches(pattern, text: str) -> bool:
+    return pattern.search(text) is not None
+
+
+def noop() -> None:
+    return None
@@ -1,42 +1,371 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, File, UploadFile, Form
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, File, UploadFile, Form, Request
+from fastapi.routing import APIRoute
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse, Response
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import CursorType, ReadPreference, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import DuplicateKeyError, ServerSelectionTimeoutError, WaitQueueTimeoutError
+from bson import Binary
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional
+from typing import Dict, List, Optional
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime, timedelta
 from passlib.context import CryptContext
 import jwt
 import uuid
 import os
+import abc
+import asyncio
 import base64
+import bisect
+import collections
+import contextvars
+import functools
+import hashlib
+import heapq
+import hmac
+import json
+import math
+import multiprocessing
+import random
 import re
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unicodedata
 from dotenv import load_dotenv
 from pathlib import Path
 import logging
+import cpu_tasks
 
 # Load environment variables
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Request profiling
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', 'false').lower() == 'true'
+PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE', 0.01))
+PROFILING_SLOW_MS = float(os.environ.get('PROFILING_SLOW_MS', 500))
+PROFILING_INTERVAL_MS = float(os.environ.get('PROFILING_INTERVAL_MS', 5))
+PROFILING_DIR = Path(os.environ.get('PROFILING_DIR', tempfile.gettempdir())) / "click-profiles"
+PROFILING_MAX_FILES = int(os.environ.get('PROFILING_MAX_FILES', 50))
+# Requests carrying this header are always profiled if they also carry an admin JWT,
+# or if the header value matches PROFILING_HEADER_TOKEN (when set)
+PROFILING_HEADER = "X-Profile-Request"
+PROFILING_HEADER_TOKEN = os.environ.get('PROFILING_HEADER_TOKEN')
+PROFILE_NAME_PATTERN = re.compile(r"^[0-9]{8}T[0-9]{6}-[0-9a-f]{32}\.json$")
+
+current_profile = contextvars.ContextVar("current_profile", default=None)
+
+class RequestProfile:
+    """Span timings and stack samples collected while a sampled request runs"""
+
+    def __init__(self, method: str, path: str, forced: bool):
+        self.id = uuid.uuid4().hex
+        self.method = method
+        self.path = path
+        self.forced = forced
+        self.started_at = datetime.utcnow()
+        self.spans = {}    # name -> [total_ms, count]
+        self.stacks = collections.Counter()  # collapsed stack -> samples
+        self.lock = threading.Lock()
+        self.endpoint_started = None
+        self.endpoint_finished = None
+
+    def add_span(self, name: str, elapsed_ms: float):
+        with self.lock:
+            span = self.spans.setdefault(name, [0.0, 0])
+            span[0] += elapsed_ms
+            span[1] += 1
+
+    def to_dict(self, duration_ms: float, status_code: int) -> dict:
+        spans = {name: {"total_ms": round(total, 3), "count": count} for name, (total, count) in self.spans.items()}
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status_code": status_code,
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": round(duration_ms, 3),
+            "forced": self.forced,
+            "spans": spans,
+            # Collapsed stacks (flamegraph.pl / speedscope format) of the event loop thread;
+            # samples can include other requests running concurrently on the same loop
+            "stacks": dict(self.stacks.most_common()),
+        }
+
+@contextmanager
+def span(name: str):
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add_span(name, (time.perf_counter() - started) * 1000)
+
+class CommandProfiler(monitoring.CommandListener):
+    """Adds Mongo command round trips to the active request profile.
+
+    Motor copies the caller's context into its executor threads, so the context
+    variable still points at the request that issued the command.
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        profile = current_profile.get()
+        if profile is not None:
+            profile.add_span(f"mongo.{event.command_name}", event.duration_micros / 1000)
+
+    def failed(self, event):
+        self.succeeded(event)
+
+class StackSampler:
+    """Samples the event loop thread's stack while at least one profile is active"""
+
+    def __init__(self):
+        self.active = set()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.target_thread_id = None
+
+    def _collapse(self, frame) -> str:
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def _run(self):
+        interval = PROFILING_INTERVAL_MS / 1000
+        while True:
+            with self.lock:
+                if not self.active:
+                    self.thread = None
+                    return
+                profiles = list(self.active)
+            frame = sys._current_frames().get(self.target_thread_id)
+            if frame is not None:
+                stack = self._collapse(frame)
+                for profile in profiles:
+                    with profile.lock:
+                        profile.stacks[stack] += 1
+            time.sleep(interval)
+
+    def add(self, profile: RequestProfile):
+        with self.lock:
+            self.active.add(profile)
+            self.target_thread_id = threading.get_ident()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+                self.thread.start()
+
+    def remove(self, profile: RequestProfile):
+        with self.lock:
+            self.active.discard(profile)
+
+stack_sampler = StackSampler()
+
+def write_profile(data: dict) -> str:
+    """Write a profile into the on-disk ring buffer, dropping the oldest beyond PROFILING_MAX_FILES"""
+    PROFILING_DIR.mkdir(parents=True, exist_ok=True)
+    name = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}-{data['id']}.json"
+    (PROFILING_DIR / name).write_text(json.dumps(data))
+    files = sorted(PROFILING_DIR.glob("*.json"))
+    for old in files[:-PROFILING_MAX_FILES]:
+        old.unlink(missing_ok=True)
+    return name
+
+class ProfiledRoute(APIRoute):
+    """Marks when the endpoint body starts and finishes, so a profile can separate
+    dependency resolution (auth, body parsing) and response serialization from the
+    handler itself."""
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        # include_router rebuilds every route with the same class around the already wrapped endpoint
+        if asyncio.iscoroutinefunction(endpoint) and not getattr(endpoint, "_profiled_route", False):
+            original = endpoint
+
+            @functools.wraps(original)
+            async def endpoint(*args, **kw):
+                profile = current_profile.get()
+                if profile is None:
+                    return await original(*args, **kw)
+                profile.endpoint_started = time.perf_counter()
+                try:
+                    return await original(*args, **kw)
+                finally:
+                    profile.endpoint_finished = time.perf_counter()
+            endpoint._profiled_route = True
+        super().__init__(path, endpoint, **kwargs)
+
 # MongoDB connection
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Connection checkout counts and wait times, collected from pymongo pool events.
+
+    pymongo checks connections out synchronously on Motor's worker threads, so the
+    start of each wait is tracked per thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.checkout_timeouts = 0
+        self.checked_out = 0
+        self.waiting = 0
+        self.connections_created = 0
+        self.connections_closed = 0
+        self.pool_clears = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+
+    def _end_wait(self) -> float:
+        started = getattr(self._local, "started", None)
+        self._local.started = None
+        return (time.perf_counter() - started) * 1000 if started is not None else 0.0
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+        with self._lock:
+            self.waiting += 1
+
+    def connection_checked_out(self, event):
+        wait_ms = self._end_wait()
+        profile = current_profile.get()
+        if profile is not None:
+            profile.add_span("mongo.pool_wait", wait_ms)
+        with self._lock:
+            self.waiting -= 1
+            self.checkouts += 1
+            self.checked_out += 1
+            self.total_wait_ms += wait_ms
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+
+    def connection_check_out_failed(self, event):
+        wait_ms = self._end_wait()
+        profile = current_profile.get()
+        if profile is not None:
+            profile.add_span("mongo.pool_wait", wait_ms)
+        with self._lock:
+            self.waiting -= 1
+            self.checkout_failures += 1
+            if event.reason == monitoring.ConnectionCheckOutFailedReason.TIMEOUT:
+                self.checkout_timeouts += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.connections_created += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.connections_closed += 1
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.pool_clears += 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "checkout_timeouts": self.checkout_timeouts,
+                "checked_out": self.checked_out,
+                "waiting": self.waiting,
+                "connections_open": self.connections_created - self.connections_closed,
+                "pool_clears": self.pool_clears,
+                "avg_wait_ms": round(self.total_wait_ms / self.checkouts, 3) if self.checkouts else 0.0,
+                "max_wait_ms": round(self.max_wait_ms, 3),
+            }
+
+def mongo_client_options() -> dict:
+    """Pool, timeout and compression settings, overridable through MONGO_* env vars"""
+    options = {
+        "maxPoolSize": int(os.environ.get('MONGO_MAX_POOL_SIZE', 100)),
+        "minPoolSize": int(os.environ.get('MONGO_MIN_POOL_SIZE', 0)),
+        "maxIdleTimeMS": int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', 300000)),
+        "waitQueueTimeoutMS": int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 2000)),
+        "serverSelectionTimeoutMS": int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000)),
+        "connectTimeoutMS": int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', 5000)),
+        "socketTimeoutMS": int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', 30000)),
+        "event_listeners": [pool_metrics, CommandProfiler()],
+    }
+    compressors = os.environ.get('MONGO_COMPRESSORS', 'zlib')
+    if compressors:
+        options["compressors"] = compressors
+    return options
+
+pool_metrics = PoolMetrics()
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, **mongo_client_options())
 db = client[os.environ['DB_NAME']]
+# Feed, search and stats tolerate slightly stale data, so they read from secondaries when available
+SECONDARY_READS = os.environ.get('MONGO_SECONDARY_READS', 'true').lower() == 'true'
+read_db = client.get_database(
+    os.environ['DB_NAME'],
+    read_preference=ReadPreference.SECONDARY_PREFERRED if SECONDARY_READS else ReadPreference.PRIMARY,
+)
 
 # Security setup
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
-SECRET_KEY = "your-secret-key-change-in-production"
+optional_security = HTTPBearer(auto_error=False)
+SECRET_KEY = os.environ.get('JWT_SECRET_KEY', "your-secret-key-change-in-production")
 ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 30
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ.get('ACCESS_TOKEN_EXPIRE_MINUTES', 15))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.environ.get('REFRESH_TOKEN_EXPIRE_DAYS', 14))
+REVOCATION_SYNC_SECONDS = float(os.environ.get('REVOCATION_SYNC_SECONDS', 2))
+# Signing keys by key id, e.g. JWT_SIGNING_KEYS='{"2025-01": "...", "2025-04": "..."}'.
+# New tokens are signed with JWT_ACTIVE_KID; older keys stay listed until their tokens expire.
+SIGNING_KEYS = json.loads(os.environ.get('JWT_SIGNING_KEYS') or 'null') or {"default": SECRET_KEY}
+ACTIVE_KID = os.environ.get('JWT_ACTIVE_KID') or next(iter(SIGNING_KEYS))
+if ACTIVE_KID not in SIGNING_KEYS:
+    raise RuntimeError(f"JWT_ACTIVE_KID {ACTIVE_KID!r} is not in JWT_SIGNING_KEYS")
 
 # Admin credentials
 ADMIN_USERNAME = "jimthesoul"
 ADMIN_PASSWORD = "Jimthesoul@#"
 
-app = FastAPI()
-api_router = APIRouter(prefix="/api")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await startup()
+    try:
+        yield
+    finally:
+        await shutdown()
+
+app = FastAPI(lifespan=lifespan)
+api_router = APIRouter(prefix="/api", route_class=ProfiledRoute)
 
 # Models
 class UserCreate(BaseModel):
@@ -61,6 +390,11 @@ class CommentCreate(BaseModel):
     content: str
     video_id: str
 
+class UserStats(BaseModel):
+    video_count: int = 0  # approved videos
+    total_views: int = 0
+    total_likes: int = 0
+
 class User(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     username: str
@@ -68,19 +402,55 @@ class User(BaseModel):
     created_at: datetime = Field(default_factory=datetime.utcnow)
     is_banned: bool = False
     ban_reason: Optional[str] = None
+    stats: UserStats = Field(default_factory=UserStats)
+
+class UserProfile(BaseModel):
+    id: str
+    username: str
+    created_at: datetime
+    stats: UserStats
+
+class HLSRendition(BaseModel):
+    name: str  # e.g. "480p"
+    height: int
+    bandwidth: int  # bits per second, as advertised in the master playlist
+    playlist: str  # path relative to the video's hls/ route
+    segments: int = 0
+    width: Optional[int] = None
+    codecs: Optional[str] = None  # RFC 6381 codec string, as advertised in the master playlist
 
 class Video(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     title: str
     description: str
     file_data: str  # base64 encoded
+    checksum: Optional[str] = None  # sha256 of the original upload
     user_id: str
     username: str
     likes: int = 0
     views: int = 0
+    comment_count: int = 0
     created_at: datetime = Field(default_factory=datetime.utcnow)
     is_flagged: bool = False
     moderation_status: str = "pending"  # pending, approved, rejected
+    hls_status: str = "unavailable"  # pending, ready, failed, unavailable
+    renditions: List[HLSRendition] = []
+
+class VideoSummary(BaseModel):
+    """Video metadata without the media bytes, for listings and search results"""
+    id: str
+    title: str
+    description: str
+    user_id: str
+    username: str
+    likes: int = 0
+    views: int = 0
+    comment_count: int = 0
+    created_at: datetime
+    is_flagged: bool = False
+    moderation_status: str = "pending"
+    hls_status: str = "unavailable"
+    renditions: List[HLSRendition] = []
 
 class Comment(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -89,6 +459,12 @@ class Comment(BaseModel):
     user_id: str
     username: str
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    moderation_status: str = "approved"  # approved, rejected
+
+class ModerationVerdict(BaseModel):
+    flagged: bool
+    score: float = 0.0
+    labels: List[str] = []
 
 class Like(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -98,30 +474,146 @@ class Like(BaseModel):
 
 # Utility functions
 def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+    with span("bcrypt"):
+        return pwd_context.hash(password)
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    with span("bcrypt"):
+        return pwd_context.verify(plain_password, hashed_password)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
+    now = datetime.utcnow()
     if expires_delta:
-        expire = datetime.utcnow() + expires_delta
+        expire = now + expires_delta
     else:
-        expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+        expire = now + timedelta(minutes=15)
+    to_encode.update({"exp": expire, "iat": now, "jti": uuid.uuid4().hex})
+    encoded_jwt = jwt.encode(to_encode, SIGNING_KEYS[ACTIVE_KID], algorithm=ALGORITHM, headers={"kid": ACTIVE_KID})
     return encoded_jwt
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+def create_token_pair(sub: str, role: str, claims: Optional[dict] = None, access_minutes: int = ACCESS_TOKEN_EXPIRE_MINUTES) -> dict:
+    """Short-lived access token plus a refresh token that can be exchanged for a new pair"""
+    access_token = create_access_token(
+        data={"sub": sub, "type": role, **(claims or {})}, expires_delta=timedelta(minutes=access_minutes)
+    )
+    refresh_token = create_access_token(
+        data={"sub": sub, "type": "refresh", "role": role}, expires_delta=timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    )
+    return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer",
+            "expires_in": access_minutes * 60}
+
+def decode_token(token: str) -> dict:
+    kid = jwt.get_unverified_header(token).get("kid", ACTIVE_KID)
+    key = SIGNING_KEYS.get(kid)
+    if key is None:
+        raise jwt.InvalidTokenError(f"Unknown key id {kid!r}")
+    return jwt.decode(token, key, algorithms=[ALGORITHM])
+
+def hash_token_id(jti: str) -> str:
+    return hashlib.sha256(jti.encode()).hexdigest()[:32]
+
+class RevocationList:
+    """In-memory copy of the `revocations` collection.
+
+    Holds hashed token ids (logouts, rotated refresh tokens) and per-user cut-off
+    times (bans), so token checks never hit the database. Each worker pulls new
+    entries every REVOCATION_SYNC_SECONDS.
+    """
+
+    SYNC_OVERLAP = timedelta(seconds=5)  # tolerate clock skew between writers
+
+    def __init__(self):
+        self.token_ids = {}   # hashed jti -> expiry
+        self.users = {}       # user_id -> (tokens issued before this time are revoked, expiry)
+        self.synced_until = None
+
+    def _apply(self, entry: dict):
+        if entry["kind"] == "token":
+            self.token_ids[entry["value"]] = entry["expires_at"]
+        elif entry["kind"] == "user":
+            revoked_before, expires_at = self.users.get(entry["value"], (entry["revoked_before"], entry["expires_at"]))
+            self.users[entry["value"]] = (max(revoked_before, entry["revoked_before"]), max(expires_at, entry["expires_at"]))
+
+    def revocation(self, payload: dict) -> Optional[str]:
+        """"token" if this token was revoked, "user" if all of the user's tokens were, else None"""
+        jti = payload.get("jti")
+        if jti and hash_token_id(jti) in self.token_ids:
+            return "token"
+        revoked_before, _ = self.users.get(payload.get("sub"), (None, None))
+        if revoked_before is not None and datetime.utcfromtimestamp(payload.get("iat", 0)) <= revoked_before:
+            return "user"
+        return None
+
+    def is_revoked(self, payload: dict) -> bool:
+        return self.revocation(payload) is not None
+
+    async def _insert(self, database, entry: dict):
+        entry["created_at"] = datetime.utcnow()
+        await database.revocations.insert_one(dict(entry))
+        # Applies locally right away and reaches other workers before their next sync
+        await invalidation_bus.publish("auth.revocation", entry)
+
+    async def revoke_token(self, database, payload: dict) -> bool:
+        """Revoke a token, returning False if it had already been revoked.
+
+        Token entries are unique by value, so concurrent calls for the same token
+        have exactly one winner, which is what makes refresh tokens single use.
+        """
+        if not payload.get("jti"):
+            return False
+        try:
+            await self._insert(database, {
+                "kind": "token", "value": hash_token_id(payload["jti"]),
+                "expires_at": datetime.utcfromtimestamp(payload["exp"]),
+            })
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def revoke_user(self, database, user_id: str):
+        now = datetime.utcnow()
+        await self._insert(database, {
+            "kind": "user", "value": user_id, "revoked_before": now,
+            "expires_at": now + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+        })
+
+    async def sync(self, database):
+        query = {}
+        if self.synced_until is not None:
+            query["created_at"] = {"$gte": self.synced_until - self.SYNC_OVERLAP}
+        now = datetime.utcnow()
+        async for entry in database.revocations.find(query, {"_id": 0}):
+            self._apply(entry)
+        self.synced_until = now
+        # Drop entries whose tokens have expired anyway
+        self.token_ids = {k: v for k, v in self.token_ids.items() if v > now}
+        self.users = {k: v for k, v in self.users.items() if v[1] > now}
+
+revocations = RevocationList()
+
+async def get_token_payload(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+        payload = decode_token(credentials.credentials)
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+    revoked = revocations.revocation(payload)
+    if revoked == "user":
+        raise HTTPException(status_code=403, detail="User is banned")
+    if revoked:
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    return payload
+
+async def get_current_user(payload: dict = Depends(get_token_payload)):
+    user_id: str = payload.get("sub")
+    if user_id is None or payload.get("type") != "user":
+        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+    
+    # Fast path: identity comes from the token, bans are enforced through the revocation list
+    if "username" in payload:
+        return {"id": user_id, "username": payload["username"]}
     
+    # Tokens issued before usernames were embedded fall back to the database
     user = await db.users.find_one({"id": user_id})
     if user is None:
         raise HTTPException(status_code=401, detail="User not found")
@@ -133,23 +625,1053 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
 
 async def get_admin_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_token(credentials.credentials)
         admin_type: str = payload.get("type")
         if admin_type != "admin":
             raise HTTPException(status_code=401, detail="Admin access required")
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid admin credentials")
+    if revocations.is_revoked(payload):
+        raise HTTPException(status_code=401, detail="Token has been revoked")
     
     return True
 
+INAPPROPRIATE_WORDS = [
+    "adult", "sexual", "porn", "xxx", "explicit", "nude", "naked", 
+    "abuse", "violence", "illegal", "drugs", "hate"
+]
+INAPPROPRIATE_PATTERN = re.compile("|".join(map(re.escape, INAPPROPRIATE_WORDS)), re.IGNORECASE)
+
 def detect_inappropriate_content(content: str) -> bool:
     """Simple content detection - replace with Google AI in production"""
-    inappropriate_words = [
-        "adult", "sexual", "porn", "xxx", "explicit", "nude", "naked", 
-        "abuse", "violence", "illegal", "drugs", "hate"
-    ]
-    content_lower = content.lower()
-    return any(word in content_lower for word in inappropriate_words)
+    return INAPPROPRIATE_PATTERN.search(content) is not None
+
+# CPU offload
+CPU_OFFLOAD_ENABLED = os.environ.get('CPU_OFFLOAD_ENABLED', 'true').lower() == 'true'
+CPU_OFFLOAD_WORKERS = int(os.environ.get('CPU_OFFLOAD_WORKERS', min(4, os.cpu_count() or 1)))
+CPU_OFFLOAD_MIN_BYTES = int(os.environ.get('CPU_OFFLOAD_MIN_BYTES', 256 * 1024))
+# Per-task overrides, e.g. CPU_OFFLOAD_THRESHOLDS='{"base64": 1048576, "moderation": 65536}'
+CPU_OFFLOAD_THRESHOLDS = json.loads(os.environ.get('CPU_OFFLOAD_THRESHOLDS') or '{}')
+
+class CPUOffloader:
+    """Runs CPU-heavy request steps without blocking the event loop.
+
+    Inputs at or above the task's size threshold go to a process pool (spawned
+    workers only import `cpu_tasks`); smaller ones run inline, where the pickling
+    round trip would cost more than the work itself. Work that releases the GIL,
+    like bcrypt or hashing a large buffer, goes to a thread instead.
+    """
+
+    def __init__(self):
+        self.pool = None
+        self.stats = collections.defaultdict(
+            lambda: {"inline": 0, "offloaded": 0, "threaded": 0, "bytes_offloaded": 0, "total_ms": 0.0, "max_ms": 0.0}
+        )
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=CPU_OFFLOAD_WORKERS,
+                                            mp_context=multiprocessing.get_context("spawn"))
+        return self.pool
+
+    def _record(self, name: str, mode: str, size: int, started: float):
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        stats = self.stats[name]
+        stats[mode] += 1
+        if mode == "offloaded":
+            stats["bytes_offloaded"] += size
+        stats["total_ms"] += elapsed_ms
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+
+    async def run(self, name: str, fn, *args, size: int = 0):
+        """Run a picklable top-level function (see cpu_tasks), offloading large inputs"""
+        started = time.perf_counter()
+        offload = CPU_OFFLOAD_ENABLED and size >= CPU_OFFLOAD_THRESHOLDS.get(name, CPU_OFFLOAD_MIN_BYTES)
+        with span(name):
+            if offload:
+                try:
+                    result = await asyncio.get_running_loop().run_in_executor(self._pool(), fn, *args)
+                except BrokenProcessPool:
+                    logger.error("CPU offload pool broke while running %s, recreating it", name)
+                    self.pool = None
+                    offload = False
+                    result = fn(*args)
+            else:
+                result = fn(*args)
+        self._record(name, "offloaded" if offload else "inline", size, started)
+        return result
+
+    async def run_in_thread(self, name: str, fn, *args):
+        started = time.perf_counter()
+        context = contextvars.copy_context()
+        result = await asyncio.get_running_loop().run_in_executor(None, functools.partial(context.run, fn, *args))
+        self._record(name, "threaded", 0, started)
+        return result
+
+    async def warm_up(self):
+        if not CPU_OFFLOAD_ENABLED:
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._pool(), cpu_tasks.noop)
+        except (BrokenProcessPool, OSError) as e:
+            # Not fatal: run() recreates the pool, or falls back to inline work, on first use
+            logger.warning("CPU offload pool failed to start: %s", e)
+            self.shutdown()
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    def snapshot(self) -> dict:
+        return {name: {**stats, "total_ms": round(stats["total_ms"], 3), "max_ms": round(stats["max_ms"], 3)}
+                for name, stats in self.stats.items()}
+
+cpu_offloader = CPUOffloader()
+
+async def scan_inappropriate_content(*texts: str) -> bool:
+    for text in texts:
+        if await cpu_offloader.run("moderation", cpu_tasks.pattern_matches, INAPPROPRIATE_PATTERN, text, size=len(text)):
+            return True
+    return False
+
+class CounterBuffer:
+    """Buffers `$inc` updates in memory and writes them to Mongo in one bulk write.
+
+    Used for hot counters such as video views, where losing the exact ordering of
+    increments is fine but a write per request is not.
+    """
+
+    def __init__(self, collection: str, field: str):
+        self.collection = collection
+        self.field = field
+        self.pending = {}
+
+    def incr(self, key: str, amount: int = 1):
+        self.pending[key] = self.pending.get(key, 0) + amount
+
+    def get(self, key: str) -> int:
+        return self.pending.get(key, 0)
+
+    def discard(self, key: str):
+        self.pending.pop(key, None)
+
+    async def flush(self, database):
+        if not self.pending:
+            return 0
+        pending, self.pending = self.pending, {}
+        operations = [UpdateOne({"id": key}, {"$inc": {self.field: amount}})
+                      for key, amount in pending.items() if amount]
+        try:
+            if operations:
+                await database[self.collection].bulk_write(operations, ordered=False)
+        except Exception:
+            # Put the increments back so the next flush retries them
+            for key, amount in pending.items():
+                self.incr(key, amount)
+            raise
+        return len(operations)
+
+view_counter = CounterBuffer("videos", "views")
+user_view_counter = CounterBuffer("users", "stats.total_views")
+
+# HLS packaging
+HLS_ENABLED = os.environ.get('HLS_ENABLED', 'true').lower() == 'true'
+HLS_SEGMENT_SECONDS = int(os.environ.get('HLS_SEGMENT_SECONDS', 4))
+HLS_MAX_CONCURRENT_JOBS = int(os.environ.get('HLS_MAX_CONCURRENT_JOBS', 1))
+HLS_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# The master playlist is cached briefly so moderation changes still take effect at the edge
+HLS_MASTER_CACHE_CONTROL = "public, max-age=300"
+# (name, height, video bitrate, audio bitrate)
+HLS_LADDER = [
+    ("240p", 240, 400_000, 64_000),
+    ("480p", 480, 1_000_000, 96_000),
+    ("720p", 720, 2_500_000, 128_000),
+]
+# H.264 Main profile level 3.1 (enough for 720p30) and AAC-LC; ffmpeg is pinned to these
+HLS_VIDEO_CODEC = "avc1.4d401f"
+HLS_AUDIO_CODEC = "mp4a.40.2"
+# Uploads are stored without their content type; the upload form only accepts video
+VIDEO_FILE_CONTENT_TYPE = "video/mp4"
+BYTE_RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+HLS_CONTENT_TYPES = {".m3u8": "application/vnd.apple.mpegurl", ".ts": "video/mp2t"}
+HLS_PATH_PATTERN = re.compile(r"^[0-9]+p/(index\.m3u8|seg_[0-9]+\.ts)$")
+
+# A worker renews its packaging lease every third of this; the lease lapses if the worker dies
+HLS_LEASE_SECONDS = int(os.environ.get('HLS_LEASE_SECONDS', 120))
+HLS_WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+hls_semaphore = asyncio.Semaphore(HLS_MAX_CONCURRENT_JOBS)
+hls_jobs = set()
+hls_queued = set()  # video ids with a job scheduled in this worker
+
+async def run_media_tool(*args: str, stderr_output: bool = False) -> bytes:
+    process = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        # Don't leave the tool running against a working directory that is about to be removed
+        process.kill()
+        await process.wait()
+        raise
+    if process.returncode != 0:
+        raise RuntimeError(f"{args[0]} exited with {process.returncode}: {stderr.decode(errors='replace')[-500:]}")
+    return stderr if stderr_output else stdout
+
+FFMPEG_VIDEO_STREAM_PATTERN = re.compile(r"Stream #0:\d+.*?: Video: .*?, (\d+)x(\d+)")
+
+async def probe_source(source: str) -> dict:
+    """Width and height of the first video stream and whether there is audio (empty if unknown)"""
+    if not shutil.which("ffprobe"):
+        # Static ffmpeg builds often ship without ffprobe; read ffmpeg's own input summary instead
+        output = await run_media_tool(
+            "ffmpeg", "-hide_banner", "-i", source, "-map", "0", "-c", "copy", "-t", "0", "-f", "null", "-",
+            stderr_output=True,
+        )
+        summary = output.decode(errors="replace").split("Stream mapping:")[0]
+        match = FFMPEG_VIDEO_STREAM_PATTERN.search(summary)
+        return {
+            "width": int(match.group(1)) if match else None,
+            "height": int(match.group(2)) if match else None,
+            "has_audio": ": Audio: " in summary,
+        }
+    output = await run_media_tool(
+        "ffprobe", "-v", "error", "-show_entries", "stream=codec_type,width,height", "-of", "json", source
+    )
+    try:
+        streams = json.loads(output).get("streams", [])
+    except ValueError:
+        return {}
+    video = next((stream for stream in streams if stream.get("codec_type") == "video"), {})
+    return {
+        "width": video.get("width"),
+        "height": video.get("height"),
+        "has_audio": any(stream.get("codec_type") == "audio" for stream in streams),
+    }
+
+def scaled_width(source: dict, height: int) -> Optional[int]:
+    """Output width for `scale=-2:height`: keeps the aspect ratio, rounded to an even number"""
+    if not source.get("width") or not source.get("height"):
+        return None
+    return round(source["width"] * height / source["height"] / 2) * 2
+
+def select_renditions(source_height: Optional[int]) -> list:
+    """Ladder rungs at or below the source resolution (always at least the lowest one)"""
+    if source_height is None:
+        return HLS_LADDER
+    return [rung for rung in HLS_LADDER if rung[1] <= source_height] or HLS_LADDER[:1]
+
+def build_master_playlist(renditions: List[dict]) -> str:
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3"]
+    for rendition in sorted(renditions, key=lambda r: r["bandwidth"]):
+        attributes = [f"BANDWIDTH={rendition['bandwidth']}"]
+        if rendition.get("width"):
+            attributes.append(f"RESOLUTION={rendition['width']}x{rendition['height']}")
+        if rendition.get("codecs"):
+            attributes.append(f"CODECS=\"{rendition['codecs']}\"")
+        lines.append(f"#EXT-X-STREAM-INF:{','.join(attributes)}")
+        lines.append(rendition["playlist"])
+    return "\n".join(lines) + "\n"
+
+async def load_video_bytes(video_id: str) -> Optional[bytes]:
+    video = await db.videos.find_one({"id": video_id}, {"_id": 0, "file_data": 1})
+    if video is None:
+        return None
+    return await cpu_offloader.run("base64_decode", cpu_tasks.b64decode_text, video["file_data"],
+                                   size=len(video["file_data"]))
+
+async def claim_hls_job(video_id: str) -> bool:
+    """Take the packaging lease on a pending video unless a live worker holds it"""
+    now = datetime.utcnow()
+    claimed = await db.videos.find_one_and_update(
+        {"id": video_id, "hls_status": "pending",
+         "$or": [{"hls_lease_until": None}, {"hls_lease_until": {"$lt": now}}]},
+        {"$set": {"hls_owner": HLS_WORKER_ID, "hls_lease_until": now + timedelta(seconds=HLS_LEASE_SECONDS)}},
+        projection={"_id": 1},
+    )
+    return claimed is not None
+
+async def renew_hls_lease(video_id: str):
+    while True:
+        await asyncio.sleep(HLS_LEASE_SECONDS / 3)
+        result = await db.videos.update_one(
+            {"id": video_id, "hls_owner": HLS_WORKER_ID},
+            {"$set": {"hls_lease_until": datetime.utcnow() + timedelta(seconds=HLS_LEASE_SECONDS)}},
+        )
+        if result.matched_count == 0:
+            logger.warning("Lost the HLS packaging lease on video %s", video_id)
+            return
+
+async def release_hls_lease(video_id: str, update: Optional[dict] = None):
+    """Drop this worker's lease. Its segments are kept only when `update` marks the video ready."""
+    result = await db.videos.update_one(
+        {"id": video_id, "hls_owner": HLS_WORKER_ID},
+        {"$set": update or {}, "$unset": {"hls_owner": "", "hls_lease_until": ""}},
+    )
+    if result.matched_count == 0 or not update or update.get("hls_status") != "ready":
+        # Deleted, taken over after the lease expired, interrupted or failed
+        await db.hls_segments.delete_many({"video_id": video_id, "owner": HLS_WORKER_ID})
+
+async def transcode_hls(video_id: str) -> Optional[List[dict]]:
+    """Package the stored upload; None if the video no longer exists"""
+    file_content = await load_video_bytes(video_id)
+    if file_content is None:
+        return None
+    with tempfile.TemporaryDirectory(prefix="hls-") as workdir:
+        source = os.path.join(workdir, "source")
+        await asyncio.to_thread(Path(source).write_bytes, file_content)
+        del file_content
+        
+        probe = await probe_source(source)
+        codecs = HLS_VIDEO_CODEC if probe.get("has_audio") is False else f"{HLS_VIDEO_CODEC},{HLS_AUDIO_CODEC}"
+        renditions = []
+        for name, height, video_bitrate, audio_bitrate in select_renditions(probe.get("height")):
+            output_dir = os.path.join(workdir, name)
+            os.makedirs(output_dir)
+            await run_media_tool(
+                "ffmpeg", "-y", "-loglevel", "error", "-i", source,
+                "-map", "0:v:0", "-map", "0:a:0?",
+                "-vf", f"scale=-2:{height}",
+                "-c:v", "libx264", "-preset", "veryfast", "-profile:v", "main", "-level", "3.1", "-pix_fmt", "yuv420p",
+                "-b:v", str(video_bitrate), "-maxrate", str(int(video_bitrate * 1.07)),
+                "-bufsize", str(video_bitrate * 2),
+                "-force_key_frames", f"expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})",
+                "-c:a", "aac", "-b:a", str(audio_bitrate), "-ac", "2",
+                "-f", "hls", "-hls_time", str(HLS_SEGMENT_SECONDS), "-hls_playlist_type", "vod",
+                "-hls_segment_filename", os.path.join(output_dir, "seg_%04d.ts"),
+                os.path.join(output_dir, "index.m3u8"),
+            )
+            
+            files = sorted(os.listdir(output_dir))
+            documents = []
+            for filename in files:
+                data = await asyncio.to_thread(Path(output_dir, filename).read_bytes)
+                documents.append({"video_id": video_id, "path": f"{name}/{filename}", "owner": HLS_WORKER_ID,
+                                  "data": Binary(data)})
+            await db.hls_segments.insert_many(documents)
+            renditions.append(HLSRendition(
+                name=name, height=height, bandwidth=video_bitrate + audio_bitrate,
+                playlist=f"{name}/index.m3u8", segments=sum(1 for f in files if f.endswith(".ts")),
+                width=scaled_width(probe, height), codecs=codecs
+            ).dict())
+    return renditions
+
+async def package_hls(video_id: str):
+    """Transcode an upload into an HLS bitrate ladder and store the playlists and
+    segments in the `hls_segments` collection.
+
+    The job claims a lease on the video first, so only one worker packages it
+    even when several requeue it. The lease is renewed while ffmpeg runs and
+    lapses if the worker dies. The upload is read only once the job has a slot,
+    so queued jobs don't hold uploads in memory.
+    """
+    if not shutil.which("ffmpeg"):
+        await db.videos.update_one({"id": video_id}, {"$set": {"hls_status": "unavailable"}})
+        logger.warning("ffmpeg not found, serving video %s without HLS renditions", video_id)
+        return
+    
+    async with hls_semaphore:
+        if not await claim_hls_job(video_id):
+            # Already packaged, deleted, or a live worker holds the lease
+            return
+        renewal = asyncio.create_task(renew_hls_lease(video_id))
+        try:
+            # Leftovers from an attempt whose lease expired
+            await db.hls_segments.delete_many({"video_id": video_id})
+            renditions = await transcode_hls(video_id)
+            if renditions is None:
+                return
+        except BaseException:
+            await release_hls_lease(video_id)
+            raise
+        finally:
+            renewal.cancel()
+    
+    await release_hls_lease(video_id, {"hls_status": "ready", "renditions": renditions})
+
+async def run_hls_job(video_id: str):
+    try:
+        await package_hls(video_id)
+    except asyncio.CancelledError:
+        # The lease was released, so the video stays "pending" for another worker
+        raise
+    except Exception as e:
+        logger.error("HLS packaging failed for video %s: %s", video_id, e)
+        await db.videos.update_one({"id": video_id, "hls_status": "pending", "hls_owner": {"$exists": False}},
+                                   {"$set": {"hls_status": "failed"}})
+
+def schedule_hls_job(video_id: str):
+    if not HLS_ENABLED or video_id in hls_queued:
+        return
+    task = asyncio.create_task(run_hls_job(video_id))
+    hls_queued.add(video_id)
+    hls_jobs.add(task)
+    task.add_done_callback(hls_jobs.discard)
+    task.add_done_callback(lambda _: hls_queued.discard(video_id))
+
+async def reconcile_hls_status():
+    """Mark videos unavailable when no packaging job will ever run for them: ones
+    stored before HLS packaging existed, or left pending while it was disabled."""
+    await db.videos.update_many({"hls_status": {"$exists": False}}, {"$set": {"hls_status": "unavailable"}})
+    if not HLS_ENABLED:
+        await db.videos.update_many({"hls_status": "pending"}, {"$set": {"hls_status": "unavailable"}})
+
+async def requeue_hls_jobs():
+    """Resume packaging for uploads whose worker stopped before finishing (lease expired or released)"""
+    if not HLS_ENABLED:
+        return
+    query = {"hls_status": "pending", "$or": [{"hls_lease_until": None}, {"hls_lease_until": {"$lt": datetime.utcnow()}}]}
+    async for video in db.videos.find(query, {"_id": 0, "id": 1}):
+        schedule_hls_job(video["id"])
+
+async def requeue_hls_jobs_periodically():
+    while True:
+        await asyncio.sleep(HLS_LEASE_SECONDS)
+        try:
+            await requeue_hls_jobs()
+        except Exception as e:
+            logger.error("Failed to requeue HLS jobs: %s", e)
+
+# Moderation pipeline
+MODERATION_CLASSIFIER = os.environ.get('MODERATION_CLASSIFIER', 'mock')
+MODERATION_BATCH_SIZE = int(os.environ.get('MODERATION_BATCH_SIZE', 32))
+MODERATION_BATCH_WINDOW_MS = int(os.environ.get('MODERATION_BATCH_WINDOW_MS', 50))
+MODERATION_CACHE_SIZE = int(os.environ.get('MODERATION_CACHE_SIZE', 10000))
+# Items whose classification or write-back fails are retried with exponential backoff
+MODERATION_MAX_ATTEMPTS = int(os.environ.get('MODERATION_MAX_ATTEMPTS', 5))
+MODERATION_RETRY_BASE_SECONDS = float(os.environ.get('MODERATION_RETRY_BASE_SECONDS', 1))
+MODERATION_RETRY_MAX_SECONDS = float(os.environ.get('MODERATION_RETRY_MAX_SECONDS', 60))
+# When true, uploads stay "pending" (hidden from the feed) until the classifier has approved them
+MODERATION_HOLD_UNTIL_CLASSIFIED = os.environ.get('MODERATION_HOLD_UNTIL_CLASSIFIED', 'false').lower() == 'true'
+
+class ModerationClassifier(abc.ABC):
+    """Backend interface for the async moderation stage.
+
+    Implementations receive a batch of texts and return one verdict per text, in
+    order. Register new backends in CLASSIFIER_BACKENDS and select them with the
+    MODERATION_CLASSIFIER env var.
+    """
+
+    @abc.abstractmethod
+    async def classify(self, texts: List[str]) -> List[ModerationVerdict]:
+        ...
+
+class MockClassifier(ModerationClassifier):
+    """Local stand-in for a hosted classifier: scores texts against labelled word lists"""
+
+    LABELS = {
+        "sexual": ["adult", "sexual", "porn", "xxx", "explicit", "nude", "naked", "nsfw", "onlyfans"],
+        "violence": ["violence", "abuse", "gore", "kill", "murder", "weapon"],
+        "illegal": ["illegal", "drugs", "cocaine", "heroin", "meth"],
+        "hate": ["hate", "racist", "nazi"],
+        "spam": ["free money", "click here", "buy followers", "crypto giveaway"],
+    }
+    PATTERNS = {label: re.compile("|".join(map(re.escape, words)), re.IGNORECASE) for label, words in LABELS.items()}
+
+    async def classify(self, texts: List[str]) -> List[ModerationVerdict]:
+        verdicts = []
+        for text in texts:
+            labels = [label for label, pattern in self.PATTERNS.items() if pattern.search(text)]
+            verdicts.append(ModerationVerdict(flagged=bool(labels), score=min(1.0, 0.6 * len(labels)), labels=labels))
+        return verdicts
+
+CLASSIFIER_BACKENDS = {"mock": MockClassifier}
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.strip().lower().encode()).hexdigest()
+
+class ModerationPipeline:
+    """Second moderation stage, run after the inline keyword check has passed.
+
+    Titles, descriptions and comments are queued, micro-batched (up to
+    MODERATION_BATCH_SIZE items or MODERATION_BATCH_WINDOW_MS) and sent to the
+    classifier off the request path. Verdicts are cached by content hash in memory
+    and in the `moderation_verdicts` collection, and written back through
+    `moderation_status`. Items that fail, alone or with their whole batch, are
+    requeued with backoff until MODERATION_MAX_ATTEMPTS is reached.
+    """
+
+    def __init__(self, classifier: ModerationClassifier):
+        self.classifier = classifier
+        self.queue = asyncio.Queue()
+        self.cache = collections.OrderedDict()  # content hash -> ModerationVerdict
+        self.task = None
+        self.retries = set()  # timer handles of items waiting out their backoff
+        self.stats = {"submitted": 0, "batches": 0, "classified": 0, "cache_hits": 0, "flagged": 0, "errors": 0,
+                      "retried": 0, "dropped": 0}
+
+    def submit(self, kind: str, key: dict, text: str):
+        """Queue an item; `key` is the filter that targets its document, shard key included"""
+        self.stats["submitted"] += 1
+        self.queue.put_nowait((kind, key, text, 0))
+
+    def _requeue(self, item: tuple):
+        kind, key, text, attempt = item
+        attempt += 1
+        if attempt >= MODERATION_MAX_ATTEMPTS:
+            self.stats["dropped"] += 1
+            logger.error("Giving up on moderating %s %s after %d attempts", kind, key, attempt)
+            return
+        self.stats["retried"] += 1
+        delay = min(MODERATION_RETRY_MAX_SECONDS, MODERATION_RETRY_BASE_SECONDS * 2 ** (attempt - 1))
+        delay *= random.uniform(0.5, 1.0)
+
+        def put():
+            self.retries.discard(handle)
+            self.queue.put_nowait((kind, key, text, attempt))
+
+        handle = asyncio.get_running_loop().call_later(delay, put)
+        self.retries.add(handle)
+
+    def _cache_get(self, key: str) -> Optional[ModerationVerdict]:
+        verdict = self.cache.get(key)
+        if verdict is not None:
+            self.cache.move_to_end(key)
+        return verdict
+
+    def _cache_put(self, key: str, verdict: ModerationVerdict):
+        self.cache[key] = verdict
+        self.cache.move_to_end(key)
+        while len(self.cache) > MODERATION_CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+    async def _next_batch(self) -> list:
+        batch = [await self.queue.get()]
+        deadline = asyncio.get_running_loop().time() + MODERATION_BATCH_WINDOW_MS / 1000
+        while len(batch) < MODERATION_BATCH_SIZE:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _verdicts(self, texts: List[str]) -> Dict[str, ModerationVerdict]:
+        verdicts = {}
+        missing = {}
+        for text in texts:
+            key = content_hash(text)
+            cached = self._cache_get(key)
+            if cached is not None:
+                verdicts[key] = cached
+                self.stats["cache_hits"] += 1
+            else:
+                missing[key] = text
+        if missing:
+            async for stored in db.moderation_verdicts.find({"hash": {"$in": list(missing)}}, {"_id": 0}):
+                verdict = ModerationVerdict(**stored["verdict"])
+                verdicts[stored["hash"]] = verdict
+                self._cache_put(stored["hash"], verdict)
+                self.stats["cache_hits"] += 1
+                missing.pop(stored["hash"], None)
+        if missing:
+            keys = list(missing)
+            results = await self.classifier.classify([missing[key] for key in keys])
+            if len(results) != len(keys):
+                raise ValueError(f"Classifier returned {len(results)} verdicts for {len(keys)} texts")
+            self.stats["classified"] += len(keys)
+            for key, verdict in zip(keys, results):
+                verdicts[key] = verdict
+                self._cache_put(key, verdict)
+            try:
+                await db.moderation_verdicts.insert_many(
+                    [{"hash": key, "verdict": verdicts[key].dict(), "created_at": datetime.utcnow()} for key in keys]
+                )
+            except Exception as e:
+                # The verdicts are still applied and cached in memory; only the shared cache misses out
+                logger.warning("Failed to store %d moderation verdicts: %s", len(keys), e)
+        return verdicts
+
+    async def _process(self, batch: list):
+        try:
+            verdicts = await self._verdicts([text for _, _, text, _ in batch])
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error("Moderation batch of %d items failed: %s", len(batch), e)
+            for item in batch:
+                self._requeue(item)
+            return
+        for item in batch:
+            kind, key, text, _ = item
+            verdict = verdicts[content_hash(text)]
+            try:
+                if kind == "video":
+                    await apply_video_verdict(key, verdict)
+                elif kind == "comment":
+                    await apply_comment_verdict(key, verdict)
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error("Failed to apply moderation verdict to %s %s: %s", kind, key, e)
+                self._requeue(item)
+                continue
+            if verdict.flagged:
+                self.stats["flagged"] += 1
+
+    async def run(self):
+        while True:
+            batch = await self._next_batch()
+            self.stats["batches"] += 1
+            try:
+                await self._process(batch)
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error("Moderation batch of %d items failed: %s", len(batch), e)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self, timeout: float = 5):
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Stopping moderation pipeline with %d items queued", self.queue.qsize())
+        if self.retries:
+            # Held uploads are picked up again by requeue_pending_moderation on the next start
+            logger.warning("Stopping moderation pipeline with %d items awaiting retry", len(self.retries))
+            for handle in self.retries:
+                handle.cancel()
+            self.retries.clear()
+        if self.task:
+            self.task.cancel()
+
+moderation_pipeline = ModerationPipeline(CLASSIFIER_BACKENDS[MODERATION_CLASSIFIER]())
+
+async def apply_video_verdict(key: dict, verdict: ModerationVerdict):
+    # Never override a decision an admin has made by hand
+    query = {**key, "moderated_by": {"$ne": "admin"}}
+    if verdict.flagged:
+        update = {"moderation_status": "rejected", "is_flagged": True, "moderated_by": "classifier",
+                  "rejection_reason": f"Automated moderation: {', '.join(verdict.labels)}"}
+        query["moderation_status"] = {"$ne": "rejected"}
+    else:
+        update = {"moderation_status": "approved", "moderated_by": "classifier"}
+        query["moderation_status"] = "pending"
+    previous = await db.videos.find_one_and_update(
+        query, {"$set": update}, projection={"_id": 0, "user_id": 1, "moderation_status": 1}
+    )
+    if previous is None:
+        return
+    if (previous["moderation_status"] == "approved") != (update["moderation_status"] == "approved"):
+        await db.users.update_one({"id": previous["user_id"]},
+                                  {"$inc": {"stats.video_count": 1 if update["moderation_status"] == "approved" else -1}})
+    await invalidation_bus.publish("search.video_status", {"video_id": key["id"], "status": update["moderation_status"]})
+
+async def apply_comment_verdict(key: dict, verdict: ModerationVerdict):
+    if not verdict.flagged:
+        return
+    comment = await db.comments.find_one_and_update(
+        {**key, "moderation_status": {"$ne": "rejected"}},
+        {"$set": {"moderation_status": "rejected"}}, projection={"_id": 0, "video_id": 1}
+    )
+    if comment is None:
+        return
+    await db.videos.update_one({"id": comment["video_id"]}, {"$inc": {"comment_count": -1}})
+    await invalidation_bus.publish("search.comment_removed", {"comment_id": key["id"]})
+
+async def requeue_pending_moderation():
+    """Resubmit uploads held for classification when a previous worker stopped"""
+    async for video in db.videos.find({"moderation_status": "pending"}, {"_id": 0, "id": 1, "title": 1, "description": 1}):
+        moderation_pipeline.submit("video", {"id": video["id"]}, f"{video['title']}\n{video['description']}")
+
+# Search index
+VIDEO_SUMMARY_PROJECTION = {"_id": 0, "file_data": 0}
+SEARCH_FIELD_WEIGHTS = {"title": 3.0, "description": 1.0, "comment": 0.5}
+TOKEN_PATTERN = re.compile(r"\w+")
+
+def tokenize(text: str) -> List[str]:
+    """Split text into case- and accent-folded word tokens in any script"""
+    if not text:
+        return []
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    folded = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return TOKEN_PATTERN.findall(unicodedata.normalize("NFC", folded))
+
+def encode_cursor(data: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+def decode_cursor(cursor: str) -> dict:
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(position, dict) or not isinstance(position.get("id"), str):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return position
+
+class SearchIndex:
+    """In-process inverted index over video titles, descriptions and comments.
+
+    Postings map a token to {video_id: weighted term frequency}, so a query only
+    touches the videos that contain its terms. The vocabulary is kept sorted for
+    prefix lookups via bisect.
+    """
+
+    def __init__(self):
+        self.postings = {}   # token -> {video_id: weight}
+        self.vocabulary = [] # sorted list of tokens
+        self.videos = {}     # video_id -> {"status", "user_id", "tokens"}
+        self.comments = {}   # comment_id -> (video_id, tokens)
+        self.video_comments = {}  # video_id -> set of comment_ids
+        self.ready = False
+
+    def _add_tokens(self, video_id: str, tokens: List[str], weight: float):
+        for token in tokens:
+            docs = self.postings.get(token)
+            if docs is None:
+                docs = self.postings[token] = {}
+                bisect.insort(self.vocabulary, token)
+            docs[video_id] = docs.get(video_id, 0.0) + weight
+
+    def _remove_tokens(self, video_id: str, tokens: List[str], weight: float):
+        for token in tokens:
+            docs = self.postings.get(token)
+            if not docs or video_id not in docs:
+                continue
+            docs[video_id] -= weight
+            if docs[video_id] <= 1e-9:
+                del docs[video_id]
+            if not docs:
+                del self.postings[token]
+                del self.vocabulary[bisect.bisect_left(self.vocabulary, token)]
+
+    def add_video(self, video: dict):
+        self.remove_video(video["id"], keep_comments=True)
+        title_tokens = tokenize(video.get("title", ""))
+        description_tokens = tokenize(video.get("description", ""))
+        self._add_tokens(video["id"], title_tokens, SEARCH_FIELD_WEIGHTS["title"])
+        self._add_tokens(video["id"], description_tokens, SEARCH_FIELD_WEIGHTS["description"])
+        self.videos[video["id"]] = {
+            "status": video.get("moderation_status", "pending"),
+            "user_id": video.get("user_id"),
+            "tokens": (title_tokens, description_tokens),
+        }
+
+    def remove_video(self, video_id: str, keep_comments: bool = False):
+        entry = self.videos.pop(video_id, None)
+        if entry:
+            title_tokens, description_tokens = entry["tokens"]
+            self._remove_tokens(video_id, title_tokens, SEARCH_FIELD_WEIGHTS["title"])
+            self._remove_tokens(video_id, description_tokens, SEARCH_FIELD_WEIGHTS["description"])
+        if not keep_comments:
+            for comment_id in list(self.video_comments.get(video_id, ())):
+                self.remove_comment(comment_id)
+
+    def set_status(self, video_id: str, status: str):
+        if video_id in self.videos:
+            self.videos[video_id]["status"] = status
+
+    def set_user_status(self, user_id: str, from_status: str, to_status: str):
+        for entry in self.videos.values():
+            if entry["user_id"] == user_id and entry["status"] == from_status:
+                entry["status"] = to_status
+
+    def add_comment(self, comment: dict):
+        self.remove_comment(comment["id"])
+        tokens = tokenize(comment.get("content", ""))
+        self.comments[comment["id"]] = (comment["video_id"], tokens)
+        self.video_comments.setdefault(comment["video_id"], set()).add(comment["id"])
+        self._add_tokens(comment["video_id"], tokens, SEARCH_FIELD_WEIGHTS["comment"])
+
+    def remove_comment(self, comment_id: str):
+        entry = self.comments.pop(comment_id, None)
+        if entry:
+            video_id, tokens = entry
+            self.video_comments.get(video_id, set()).discard(comment_id)
+            self._remove_tokens(video_id, tokens, SEARCH_FIELD_WEIGHTS["comment"])
+
+    def _expand(self, term: str, prefix: bool) -> List[str]:
+        if not prefix:
+            return [term] if term in self.postings else []
+        start = bisect.bisect_left(self.vocabulary, term)
+        # First string past every token starting with `term`, whatever its later code points
+        end = bisect.bisect_left(self.vocabulary, term[:-1] + chr(ord(term[-1]) + 1))
+        return self.vocabulary[start:end]
+
+    def search(self, query: str, status: Optional[str] = "approved", limit: int = 20,
+               after: Optional[tuple] = None, prefix: bool = True) -> List[tuple]:
+        """Return up to `limit` (score, video_id) pairs ranked by tf-idf.
+
+        `after` is the (score, video_id) of the last result on the previous page.
+        Every query term must match (AND semantics); with `prefix` the last term
+        also matches any token it is a prefix of.
+        """
+        terms = tokenize(query)
+        if not terms:
+            return []
+        total = max(len(self.videos), 1)
+        scores = None
+        for position, term in enumerate(terms):
+            expanded = self._expand(term, prefix and position == len(terms) - 1)
+            term_scores = {}
+            for token in expanded:
+                docs = self.postings[token]
+                idf = math.log(1 + total / len(docs))
+                for video_id, weight in docs.items():
+                    term_scores[video_id] = term_scores.get(video_id, 0.0) + weight * idf
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {vid: s + term_scores[vid] for vid, s in scores.items() if vid in term_scores}
+            if not scores:
+                return []
+        candidates = (
+            (round(score, 6), video_id) for video_id, score in scores.items()
+            if video_id in self.videos and (status is None or self.videos[video_id]["status"] == status)
+        )
+        if after is not None:
+            last_score, last_id = after
+            candidates = (c for c in candidates if (-c[0], c[1]) > (-last_score, last_id))
+        return heapq.nsmallest(limit, candidates, key=lambda c: (-c[0], c[1]))
+
+    async def load(self, database):
+        async for video in database.videos.find({}, VIDEO_SUMMARY_PROJECTION):
+            self.add_video(video)
+        async for comment in database.comments.find({}, {"_id": 0, "id": 1, "video_id": 1, "content": 1}):
+            self.add_comment(comment)
+        self.ready = True
+
+search_index = SearchIndex()
+search_index_lock = asyncio.Lock()
+search_index_backlog = None  # updates seen while a rebuild is loading
+
+def update_search_index(method: str, *args):
+    getattr(search_index, method)(*args)
+    if search_index_backlog is not None:
+        search_index_backlog.append((method, args))
+
+async def rebuild_search_index(only_if_missing: bool = False):
+    """Load a fresh index off to the side and swap it in once complete.
+
+    Searches keep using the current index meanwhile. Updates that arrive during
+    the load are replayed onto the new index before the swap; every update is
+    idempotent, so replaying one the load already picked up is harmless.
+    """
+    global search_index, search_index_backlog
+    async with search_index_lock:
+        if only_if_missing and search_index.ready:
+            return search_index
+        search_index_backlog = []
+        try:
+            index = SearchIndex()
+            await index.load(db)
+            for method, args in search_index_backlog:
+                getattr(index, method)(*args)
+            search_index = index
+        finally:
+            search_index_backlog = None
+    return search_index
+
+async def ensure_search_index():
+    if not search_index.ready:
+        await rebuild_search_index(only_if_missing=True)
+    return search_index
+
+async def is_admin_request(credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)) -> bool:
+    if credentials is None:
+        return False
+    try:
+        payload = decode_token(credentials.credentials)
+    except jwt.PyJWTError:
+        return False
+    return payload.get("type") == "admin" and not revocations.is_revoked(payload)
+
+
+# Sharding and cross-worker invalidation
+# Shard keys per collection. Queries and updates on these collections include the
+# shard key so mongos can route them to a single shard.
+SHARD_KEYS = {
+    "videos": {"id": "hashed"},
+    "users": {"id": "hashed"},
+    "comments": {"video_id": 1},
+    "likes": {"video_id": 1},
+    "hls_segments": {"video_id": 1},
+    "moderation_verdicts": {"hash": "hashed"},
+}
+MONGO_SHARDING_ENABLED = os.environ.get('MONGO_SHARDING_ENABLED', 'false').lower() == 'true'
+INVALIDATION_BUS = os.environ.get('INVALIDATION_BUS', 'mongo')  # mongo or local
+INVALIDATION_COLLECTION = "invalidation_events"
+INVALIDATION_COLLECTION_BYTES = int(os.environ.get('INVALIDATION_COLLECTION_BYTES', 16 * 1024 * 1024))
+SEARCH_VIDEO_FIELDS = {"id", "title", "description", "user_id", "moderation_status"}
+
+async def ensure_sharding():
+    """Shard collections by SHARD_KEYS when running against a sharded cluster (mongos)"""
+    if not MONGO_SHARDING_ENABLED:
+        return
+    database = os.environ['DB_NAME']
+    await client.admin.command("enableSharding", database)
+    for collection, key in SHARD_KEYS.items():
+        await db[collection].create_index(list(key.items()))
+        await client.admin.command("shardCollection", f"{database}.{collection}", key=key)
+
+class InvalidationBus:
+    """In-process stand-in: events are applied to this worker's caches only.
+
+    Caches (search index, revocation list) never mutate themselves directly;
+    writers publish an event and every worker applies it through the handlers
+    registered with subscribe(). Fine for a single worker and for tests.
+    """
+
+    def __init__(self):
+        self.handlers = collections.defaultdict(list)
+        self.resync_handlers = []
+        self.origin = uuid.uuid4().hex
+        self.stats = {"published": 0, "received": 0, "resyncs": 0}
+
+    def subscribe(self, event_type: str, handler):
+        self.handlers[event_type].append(handler)
+
+    def on_resync(self, handler):
+        """Register a coroutine that rebuilds a cache when events may have been missed"""
+        self.resync_handlers.append(handler)
+
+    def dispatch(self, event_type: str, payload: dict):
+        for handler in self.handlers.get(event_type, []):
+            try:
+                handler(**payload)
+            except Exception as e:
+                logger.error("Invalidation handler for %s failed: %s", event_type, e)
+
+    async def publish(self, event_type: str, payload: dict):
+        self.stats["published"] += 1
+        self.dispatch(event_type, payload)
+
+    async def resync(self):
+        self.stats["resyncs"] += 1
+        for handler in self.resync_handlers:
+            await handler()
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+class MongoInvalidationBus(InvalidationBus):
+    """Fans events out to every worker and node through a capped collection.
+
+    Each worker tails the collection and applies events from other origins. If the
+    last event it saw has been overwritten (the worker fell too far behind), it
+    runs the resync handlers instead of serving stale data.
+
+    The database write behind an event has already happened when it is published,
+    so a failed insert doesn't fail the request. The worker instead keeps trying to
+    publish a "bus.resync" event, which makes every other worker rebuild its caches
+    from the database.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.task = None
+        self.resync_task = None
+        self.last_id = None
+        self.stats["publish_failures"] = 0
+
+    async def _insert(self, event_type: str, payload: dict):
+        await db[INVALIDATION_COLLECTION].insert_one(
+            {"origin": self.origin, "type": event_type, "payload": payload, "created_at": datetime.utcnow()}
+        )
+
+    async def publish(self, event_type: str, payload: dict):
+        await super().publish(event_type, payload)
+        try:
+            await self._insert(event_type, payload)
+        except Exception as e:
+            self.stats["publish_failures"] += 1
+            logger.error("Failed to publish invalidation event %s, other workers will resync: %s", event_type, e)
+            if self.resync_task is None or self.resync_task.done():
+                self.resync_task = asyncio.create_task(self._request_resync())
+
+    async def _request_resync(self):
+        attempt = 0
+        while True:
+            attempt += 1
+            await asyncio.sleep(min(2 ** attempt * 0.25, 5))
+            try:
+                await self._insert("bus.resync", {})
+                return
+            except Exception as e:
+                logger.warning("Failed to request an invalidation resync (attempt %d): %s", attempt, e)
+
+    async def _ensure_collection(self):
+        if INVALIDATION_COLLECTION not in await db.list_collection_names():
+            try:
+                await db.create_collection(INVALIDATION_COLLECTION, capped=True, size=INVALIDATION_COLLECTION_BYTES)
+            except Exception as e:
+                # Another worker created it first
+                logger.debug("Invalidation collection already exists: %s", e)
+        # A tailable cursor on an empty capped collection dies immediately
+        await db[INVALIDATION_COLLECTION].insert_one(
+            {"origin": self.origin, "type": "bus.started", "payload": {}, "created_at": datetime.utcnow()}
+        )
+
+    async def _tail(self):
+        collection = db[INVALIDATION_COLLECTION]
+        while True:
+            try:
+                # ObjectIds are minted by each publisher's clock, so they are not ordered
+                # across workers. Resume by position in insertion ($natural) order instead,
+                # skipping everything up to the last event already seen.
+                cursor = collection.find({}, cursor_type=CursorType.TAILABLE_AWAIT, sort=[("$natural", 1)])
+                caught_up = self.last_id is None
+                skipped = None
+                while cursor.alive:
+                    async for event in cursor:
+                        if not caught_up:
+                            caught_up = event["_id"] == self.last_id
+                            skipped = event["_id"]
+                            continue
+                        self.last_id = event["_id"]
+                        if event["origin"] == self.origin:
+                            continue
+                        self.stats["received"] += 1
+                        if event["type"] == "bus.resync":
+                            logger.warning("Another worker missed publishing invalidation events, rebuilding caches")
+                            await self.resync()
+                        else:
+                            self.dispatch(event["type"], event["payload"])
+                    if not caught_up:
+                        # Read the whole collection without finding it: it has been overwritten
+                        logger.warning("Missed invalidation events, rebuilding caches")
+                        await self.resync()
+                        self.last_id = skipped
+                        caught_up = True
+                    await asyncio.sleep(0.1)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Invalidation bus tail failed: %s", e)
+            await asyncio.sleep(0.5)
+
+    async def start(self):
+        await self._ensure_collection()
+        newest = await db[INVALIDATION_COLLECTION].find_one({}, {"_id": 1}, sort=[("$natural", -1)])
+        self.last_id = newest["_id"] if newest else None
+        self.task = asyncio.create_task(self._tail())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+        if self.resync_task:
+            self.resync_task.cancel()
+
+invalidation_bus = MongoInvalidationBus() if INVALIDATION_BUS == "mongo" else InvalidationBus()
+invalidation_bus.subscribe("search.video_upsert", lambda video: update_search_index("add_video", video))
+invalidation_bus.subscribe("search.video_status", lambda video_id, status: update_search_index("set_status", video_id, status))
+invalidation_bus.subscribe("search.user_status", lambda user_id, from_status, to_status:
+                           update_search_index("set_user_status", user_id, from_status, to_status))
+invalidation_bus.subscribe("search.video_removed", lambda video_id: update_search_index("remove_video", video_id))
+invalidation_bus.subscribe("search.comment_added", lambda comment: update_search_index("add_comment", comment))
+invalidation_bus.subscribe("search.comment_removed", lambda comment_id: update_search_index("remove_comment", comment_id))
+invalidation_bus.subscribe("auth.revocation", lambda **entry: revocations._apply(entry))
+invalidation_bus.on_resync(rebuild_search_index)
+invalidation_bus.on_resync(lambda: revocations.sync(db))
 
 # Authentication endpoints
 @api_router.post("/register")
@@ -169,34 +1691,28 @@ async def register(user_data: UserCreate):
         email=user_data.email
     )
     user_dict = user.dict()
-    user_dict["password"] = hash_password(user_data.password)
+    user_dict["password"] = await cpu_offloader.run_in_thread("bcrypt", hash_password, user_data.password)
     
     await db.users.insert_one(user_dict)
     
-    # Create token
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.id, "type": "user"}, expires_delta=access_token_expires
-    )
+    # Create tokens
+    tokens = create_token_pair(user.id, "user", {"username": user.username})
     
-    return {"access_token": access_token, "token_type": "bearer", "user": user}
+    return {**tokens, "user": user}
 
 @api_router.post("/login")
 async def login(user_data: UserLogin):
     user = await db.users.find_one({"email": user_data.email})
-    if not user or not verify_password(user_data.password, user["password"]):
+    if not user or not await cpu_offloader.run_in_thread("bcrypt", verify_password, user_data.password, user["password"]):
         raise HTTPException(status_code=401, detail="Incorrect email or password")
     
     if user.get("is_banned", False):
         raise HTTPException(status_code=403, detail=f"Account banned: {user.get('ban_reason', 'Violation of terms')}")
     
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user["id"], "type": "user"}, expires_delta=access_token_expires
-    )
+    tokens = create_token_pair(user["id"], "user", {"username": user["username"]})
     
     user_obj = User(**{k: v for k, v in user.items() if k != "password"})
-    return {"access_token": access_token, "token_type": "bearer", "user": user_obj}
+    return {**tokens, "user": user_obj}
 
 # Admin authentication
 @api_router.post("/admin/login")
@@ -204,33 +1720,74 @@ async def admin_login(admin_data: AdminLogin):
     if admin_data.username != ADMIN_USERNAME or admin_data.password != ADMIN_PASSWORD:
         raise HTTPException(status_code=401, detail="Invalid admin credentials")
     
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES * 4)  # Longer session for admin
-    access_token = create_access_token(
-        data={"sub": "admin", "type": "admin"}, expires_delta=access_token_expires
-    )
+    tokens = create_token_pair("admin", "admin", access_minutes=ACCESS_TOKEN_EXPIRE_MINUTES * 4)  # Longer session for admin
+    
+    return {**tokens, "admin": True}
+
+# Token refresh and logout
+@api_router.post("/token/refresh")
+async def refresh_token(token_data: dict):
+    try:
+        payload = decode_token(token_data.get("refresh_token", ""))
+    except jwt.PyJWTError:
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+    if payload.get("type") != "refresh" or revocations.is_revoked(payload):
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
     
-    return {"access_token": access_token, "token_type": "bearer", "admin": True}
+    if payload.get("role") != "admin":
+        user = await db.users.find_one({"id": payload["sub"]}, {"_id": 0, "username": 1, "is_banned": 1})
+        if user is None:
+            raise HTTPException(status_code=401, detail="User not found")
+        if user.get("is_banned", False):
+            raise HTTPException(status_code=403, detail="User is banned")
+    
+    # Refresh tokens are single use: claim this one before issuing its replacement
+    if not await revocations.revoke_token(db, payload):
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+    if payload.get("role") == "admin":
+        return create_token_pair("admin", "admin", access_minutes=ACCESS_TOKEN_EXPIRE_MINUTES * 4)
+    return create_token_pair(payload["sub"], "user", {"username": user["username"]})
+
+@api_router.post("/logout")
+async def logout(token_data: Optional[dict] = None, payload: dict = Depends(get_token_payload)):
+    await revocations.revoke_token(db, payload)
+    refresh = (token_data or {}).get("refresh_token")
+    if refresh:
+        try:
+            refresh_payload = decode_token(refresh)
+        except jwt.PyJWTError:
+            refresh_payload = None
+        if refresh_payload and refresh_payload.get("sub") == payload.get("sub"):
+            await revocations.revoke_token(db, refresh_payload)
+    return {"message": "Logged out"}
 
 # Video endpoints
 @api_router.post("/videos")
 async def upload_video(title: str = Form(...), description: str = Form(...), 
                       file: UploadFile = File(...), current_user: dict = Depends(get_current_user)):
     # Read file and convert to base64
-    file_content = await file.read()
-    file_base64 = base64.b64encode(file_content).decode('utf-8')
+    with span("upload.read"):
+        file_content = await file.read()
+    # hashlib releases the GIL on large buffers, so the checksum only needs a thread
+    # and the upload is pickled to the process pool once, for base64
+    file_base64, checksum = await asyncio.gather(
+        cpu_offloader.run("base64", cpu_tasks.b64encode_text, file_content, size=len(file_content)),
+        cpu_offloader.run_in_thread("checksum", cpu_tasks.sha256_hex, file_content),
+    )
     
     # Content moderation check
-    is_inappropriate = (detect_inappropriate_content(title) or 
-                       detect_inappropriate_content(description))
+    is_inappropriate = await scan_inappropriate_content(title, description)
     
     video = Video(
         title=title,
         description=description,
         file_data=file_base64,
+        checksum=checksum,
         user_id=current_user["id"],
         username=current_user["username"],
         is_flagged=is_inappropriate,
-        moderation_status="rejected" if is_inappropriate else "approved"
+        moderation_status="rejected" if is_inappropriate else ("pending" if MODERATION_HOLD_UNTIL_CLASSIFIED else "approved"),
+        hls_status="pending" if HLS_ENABLED else "unavailable"
     )
     
     if is_inappropriate:
@@ -239,33 +1796,261 @@ async def upload_video(title: str = Form(...), description: str = Form(...),
             {"id": current_user["id"]},
             {"$set": {"is_banned": True, "ban_reason": "Uploaded inappropriate content"}}
         )
+        await revocations.revoke_user(db, current_user["id"])
         raise HTTPException(status_code=400, detail="Content violates community guidelines. Account has been banned.")
     
     await db.videos.insert_one(video.dict())
-    return {"message": "Video uploaded successfully", "video": video}
+    if video.moderation_status == "approved":
+        await db.users.update_one({"id": current_user["id"]}, {"$inc": {"stats.video_count": 1}})
+    await invalidation_bus.publish("search.video_upsert", {"video": video.dict(include=SEARCH_VIDEO_FIELDS)})
+    moderation_pipeline.submit("video", {"id": video.id}, f"{title}\n{description}")
+    schedule_hls_job(video.id)
+    # Echo the metadata only; serializing the base64 payload back would cost as much as encoding it
+    return {"message": "Video uploaded successfully", "video": VideoSummary(**video.dict(exclude={"file_data"}))}
 
 @api_router.get("/videos")
-async def get_videos(skip: int = 0, limit: int = 20):
-    videos = await db.videos.find({"moderation_status": "approved"}).skip(skip).limit(limit).to_list(limit)
-    return [Video(**video) for video in videos]
+async def get_videos(skip: int = 0, limit: int = 20, include: Optional[str] = None, preview_limit: int = 3):
+    # include: comma separated list of "comment_count" and/or "comments_preview"
+    includes = set(filter(None, (include or "").split(",")))
+    if not includes <= FEED_INCLUDES:
+        raise HTTPException(status_code=400, detail=f"Invalid include: {', '.join(sorted(includes - FEED_INCLUDES))}")
+    
+    # Media is fetched separately (HLS or /file), so listings never carry the upload bytes
+    videos = await read_db.videos.find({"moderation_status": "approved"}, VIDEO_SUMMARY_PROJECTION) \
+        .skip(skip).limit(limit).to_list(limit)
+    if "comments_preview" not in includes:
+        return [VideoSummary(**video) for video in videos]
+    
+    previews = await fetch_comment_previews([video["id"] for video in videos], preview_limit)
+    return [{**VideoSummary(**video).dict(), "comments_preview": previews.get(video["id"], {}).get("comments", [])}
+            for video in videos]
 
 @api_router.get("/videos/{video_id}")
 async def get_video(video_id: str):
-    video = await db.videos.find_one({"id": video_id, "moderation_status": "approved"})
+    video = await db.videos.find_one({"id": video_id, "moderation_status": "approved"}, VIDEO_SUMMARY_PROJECTION)
+    if not video:
+        raise HTTPException(status_code=404, detail="Video not found")
+    
+    # Increment view count (buffered, flushed periodically)
+    view_counter.incr(video_id)
+    user_view_counter.incr(video["user_id"])
+    video["views"] += view_counter.get(video_id)
+    
+    return VideoSummary(**video)
+
+@api_router.get("/videos/{video_id}/file")
+async def get_video_file(video_id: str, request: Request):
+    """The original upload, for players without HLS renditions. Supports single byte ranges."""
+    video = await read_db.videos.find_one({"id": video_id, "moderation_status": "approved"}, {"_id": 0, "file_data": 1})
+    if not video:
+        raise HTTPException(status_code=404, detail="Video not found")
+    file_content = await cpu_offloader.run("base64_decode", cpu_tasks.b64decode_text, video["file_data"],
+                                           size=len(video["file_data"]))
+    total = len(file_content)
+    headers = {"Accept-Ranges": "bytes", "Cache-Control": HLS_CACHE_CONTROL}
+    
+    match = BYTE_RANGE_PATTERN.match(request.headers.get("range", ""))
+    if not match or match.groups() == ("", ""):
+        return Response(content=file_content, media_type=VIDEO_FILE_CONTENT_TYPE, headers=headers)
+    first, last = match.groups()
+    if first:
+        start, end = int(first), min(int(last), total - 1) if last else total - 1
+    else:
+        # Suffix range: the last N bytes
+        start, end = max(total - int(last), 0), total - 1
+    if start >= total or start > end:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{total}"})
+    headers["Content-Range"] = f"bytes {start}-{end}/{total}"
+    return Response(content=file_content[start:end + 1], status_code=206, media_type=VIDEO_FILE_CONTENT_TYPE,
+                    headers=headers)
+
+@api_router.get("/videos/{video_id}/hls/master.m3u8")
+async def get_hls_master_playlist(video_id: str):
+    video = await read_db.videos.find_one(
+        {"id": video_id, "moderation_status": "approved"}, {"_id": 0, "hls_status": 1, "renditions": 1}
+    )
+    if not video:
+        raise HTTPException(status_code=404, detail="Video not found")
+    if video.get("hls_status") != "ready":
+        raise HTTPException(status_code=404, detail="HLS renditions not available")
+    
+    return Response(content=build_master_playlist(video["renditions"]),
+                    media_type=HLS_CONTENT_TYPES[".m3u8"], headers={"Cache-Control": HLS_MASTER_CACHE_CONTROL})
+
+@api_router.get("/videos/{video_id}/hls/{rendition}/{filename}")
+async def get_hls_file(video_id: str, rendition: str, filename: str):
+    path = f"{rendition}/{filename}"
+    if not HLS_PATH_PATTERN.match(path):
+        raise HTTPException(status_code=404, detail="Not found")
+    video = await read_db.videos.find_one({"id": video_id, "moderation_status": "approved"}, {"_id": 1})
     if not video:
         raise HTTPException(status_code=404, detail="Video not found")
+    segment = await read_db.hls_segments.find_one({"video_id": video_id, "path": path}, {"_id": 0, "data": 1})
+    if not segment:
+        raise HTTPException(status_code=404, detail="Not found")
+    
+    return Response(content=bytes(segment["data"]), media_type=HLS_CONTENT_TYPES[os.path.splitext(filename)[1]],
+                    headers={"Cache-Control": HLS_CACHE_CONTROL})
+
+# Batched comment previews
+FEED_INCLUDES = {"comment_count", "comments_preview"}
+MAX_PREVIEW_COMMENTS = 10
+
+async def fetch_comment_previews(video_ids: List[str], preview_limit: int = 3) -> dict:
+    """Comment count and latest comments for a page of videos in one aggregation.
+
+    Counts come from the denormalized `comment_count` on each video; the latest
+    comments are pulled per video through the (video_id, created_at) index.
+    """
+    if not video_ids:
+        return {}
+    preview_limit = max(0, min(preview_limit, MAX_PREVIEW_COMMENTS))
+    pipeline = [
+        {"$match": {"id": {"$in": video_ids}}},
+        {"$project": {"_id": 0, "id": 1, "comment_count": 1}},
+        {"$lookup": {
+            "from": "comments",
+            "let": {"video_id": "$id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$video_id", "$$video_id"]}, "moderation_status": {"$ne": "rejected"}}},
+                {"$sort": {"created_at": -1}},
+                {"$limit": preview_limit},
+                {"$project": {"_id": 0}},
+            ],
+            "as": "comments",
+        }},
+    ]
+    if preview_limit == 0:
+        pipeline = pipeline[:2]
+    results = await read_db.videos.aggregate(pipeline).to_list(len(video_ids))
+    return {
+        result["id"]: {
+            "comment_count": result.get("comment_count", 0),
+            "comments": [Comment(**comment) for comment in result.get("comments", [])],
+        }
+        for result in results
+    }
+
+@api_router.get("/comments/batch")
+async def get_comments_batch(video_ids: str, limit: int = 3):
+    # video_ids: comma separated list of video ids, e.g. one page of the feed
+    ids = list(dict.fromkeys(filter(None, video_ids.split(","))))
+    if len(ids) > 100:
+        raise HTTPException(status_code=400, detail="Too many video ids")
+    return await fetch_comment_previews(ids, limit)
+
+async def backfill_comment_counts():
+    """Populate `comment_count` on videos stored before the counter existed"""
+    missing = await db.videos.find({"comment_count": {"$exists": False}}, {"_id": 0, "id": 1}).to_list(None)
+    if not missing:
+        return
+    ids = [video["id"] for video in missing]
+    counts = await db.comments.aggregate([
+        {"$match": {"video_id": {"$in": ids}}},
+        {"$group": {"_id": "$video_id", "count": {"$sum": 1}}},
+    ]).to_list(None)
+    count_by_id = {count["_id"]: count["count"] for count in counts}
+    for video_id in ids:
+        await db.videos.update_one({"id": video_id, "comment_count": {"$exists": False}},
+                                   {"$set": {"comment_count": count_by_id.get(video_id, 0)}})
+
+async def backfill_user_stats():
+    """Populate profile `stats` on users created before the counters existed"""
+    missing = await db.users.find({"stats": {"$exists": False}}, {"_id": 0, "id": 1}).to_list(None)
+    if not missing:
+        return
+    ids = [user["id"] for user in missing]
+    totals = await db.videos.aggregate([
+        {"$match": {"user_id": {"$in": ids}}},
+        {"$group": {
+            "_id": "$user_id",
+            "video_count": {"$sum": {"$cond": [{"$eq": ["$moderation_status", "approved"]}, 1, 0]}},
+            "total_views": {"$sum": "$views"},
+            "total_likes": {"$sum": "$likes"},
+        }},
+    ]).to_list(None)
+    totals_by_id = {total.pop("_id"): total for total in totals}
+    for user_id in ids:
+        stats = UserStats(**totals_by_id.get(user_id, {}))
+        await db.users.update_one({"id": user_id, "stats": {"$exists": False}}, {"$set": {"stats": stats.dict()}})
+
+# User profiles
+PROFILE_PAGE_INDEX = "user_id_1_moderation_status_1_created_at_-1_id_-1"
+
+@api_router.get("/users/{user_id}/profile")
+async def get_user_profile(user_id: str):
+    user = await read_db.users.find_one({"id": user_id}, {"_id": 0, "id": 1, "username": 1, "created_at": 1, "stats": 1})
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    profile = UserProfile(**{**user, "stats": user.get("stats") or {}})
+    profile.stats.total_views += user_view_counter.get(user_id)
+    return profile
+
+@api_router.get("/users/{user_id}/videos")
+async def get_user_videos(user_id: str, limit: int = 20, cursor: Optional[str] = None):
+    limit = max(1, min(limit, 100))
+    query = {"user_id": user_id, "moderation_status": "approved"}
+    if cursor:
+        position = decode_cursor(cursor)
+        try:
+            created_at = datetime.fromisoformat(position["created_at"])
+        except (KeyError, TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query["$or"] = [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "id": {"$lt": position["id"]}},
+        ]
     
-    # Increment view count
-    await db.videos.update_one({"id": video_id}, {"$inc": {"views": 1}})
-    video["views"] += 1
+    # Page through the covering index first, so only the page's documents are read
+    page = await read_db.videos.find(query, {"_id": 0, "id": 1, "created_at": 1}) \
+        .sort([("created_at", -1), ("id", -1)]).hint(PROFILE_PAGE_INDEX).limit(limit).to_list(limit)
+    videos = await read_db.videos.find({"id": {"$in": [video["id"] for video in page]}},
+                                       VIDEO_SUMMARY_PROJECTION).to_list(len(page))
+    by_id = {video["id"]: video for video in videos}
     
-    return Video(**video)
+    next_cursor = None
+    if len(page) == limit:
+        next_cursor = encode_cursor({"created_at": page[-1]["created_at"].isoformat(), "id": page[-1]["id"]})
+    return {"videos": [VideoSummary(**by_id[video["id"]]) for video in page if video["id"] in by_id],
+            "next_cursor": next_cursor}
+
+# Search
+@api_router.get("/search")
+async def search_videos(q: str, status: str = "approved", limit: int = 20, cursor: Optional[str] = None,
+                        prefix: bool = True, is_admin: bool = Depends(is_admin_request)):
+    if status not in ["approved", "pending", "rejected", "any"]:
+        raise HTTPException(status_code=400, detail="Invalid status")
+    if status != "approved" and not is_admin:
+        raise HTTPException(status_code=401, detail="Admin access required")
+    limit = max(1, min(limit, 100))
+    after = None
+    if cursor:
+        position = decode_cursor(cursor)
+        score = position.get("score")
+        if isinstance(score, bool) or not isinstance(score, (int, float)) or not math.isfinite(score):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        after = (score, position["id"])
+    
+    index = await ensure_search_index()
+    hits = index.search(q, status=None if status == "any" else status, limit=limit, after=after, prefix=prefix)
+    
+    videos = await read_db.videos.find({"id": {"$in": [video_id for _, video_id in hits]}},
+                                  VIDEO_SUMMARY_PROJECTION).to_list(len(hits))
+    by_id = {video["id"]: video for video in videos}
+    results = [{"score": score, "video": VideoSummary(**by_id[video_id])}
+               for score, video_id in hits if video_id in by_id]
+    
+    next_cursor = None
+    if len(hits) == limit:
+        next_cursor = encode_cursor({"score": hits[-1][0], "id": hits[-1][1]})
+    return {"results": results, "next_cursor": next_cursor}
 
 # Like system
 @api_router.post("/videos/{video_id}/like")
 async def like_video(video_id: str, current_user: dict = Depends(get_current_user)):
     # Check if video exists
-    video = await db.videos.find_one({"id": video_id})
+    video = await db.videos.find_one({"id": video_id}, {"_id": 0, "user_id": 1})
     if not video:
         raise HTTPException(status_code=404, detail="Video not found")
     
@@ -275,12 +2060,14 @@ async def like_video(video_id: str, current_user: dict = Depends(get_current_use
         # Unlike
         await db.likes.delete_one({"video_id": video_id, "user_id": current_user["id"]})
         await db.videos.update_one({"id": video_id}, {"$inc": {"likes": -1}})
+        await db.users.update_one({"id": video["user_id"]}, {"$inc": {"stats.total_likes": -1}})
         return {"message": "Video unliked", "liked": False}
     else:
         # Like
         like = Like(video_id=video_id, user_id=current_user["id"])
         await db.likes.insert_one(like.dict())
         await db.videos.update_one({"id": video_id}, {"$inc": {"likes": 1}})
+        await db.users.update_one({"id": video["user_id"]}, {"$inc": {"stats.total_likes": 1}})
         return {"message": "Video liked", "liked": True}
 
 @api_router.get("/videos/{video_id}/like-status")
@@ -292,12 +2079,12 @@ async def get_like_status(video_id: str, current_user: dict = Depends(get_curren
 @api_router.post("/videos/{video_id}/comments")
 async def add_comment(video_id: str, comment_data: dict, current_user: dict = Depends(get_current_user)):
     # Check if video exists
-    video = await db.videos.find_one({"id": video_id})
+    video = await db.videos.find_one({"id": video_id}, {"_id": 1})
     if not video:
         raise HTTPException(status_code=404, detail="Video not found")
     
     # Content moderation for comments
-    if detect_inappropriate_content(comment_data["content"]):
+    if await scan_inappropriate_content(comment_data["content"]):
         raise HTTPException(status_code=400, detail="Comment contains inappropriate content")
     
     comment = Comment(
@@ -308,11 +2095,15 @@ async def add_comment(video_id: str, comment_data: dict, current_user: dict = De
     )
     
     await db.comments.insert_one(comment.dict())
+    await db.videos.update_one({"id": video_id}, {"$inc": {"comment_count": 1}})
+    await invalidation_bus.publish("search.comment_added", {"comment": comment.dict(include={"id", "video_id", "content"})})
+    moderation_pipeline.submit("comment", {"video_id": video_id, "id": comment.id}, comment.content)
     return {"message": "Comment added", "comment": comment}
 
 @api_router.get("/videos/{video_id}/comments")
 async def get_comments(video_id: str, skip: int = 0, limit: int = 50):
-    comments = await db.comments.find({"video_id": video_id}).skip(skip).limit(limit).to_list(limit)
+    comments = await db.comments.find({"video_id": video_id, "moderation_status": {"$ne": "rejected"}}) \
+        .skip(skip).limit(limit).to_list(limit)
     return [Comment(**comment) for comment in comments]
 
 # Admin endpoints
@@ -330,13 +2121,20 @@ async def moderate_video(video_id: str, action: dict, admin: bool = Depends(get_
     if status not in ["approved", "rejected"]:
         raise HTTPException(status_code=400, detail="Invalid status")
     
-    update_data = {"moderation_status": status}
+    update_data = {"moderation_status": status, "moderated_by": "admin"}
     if status == "rejected":
         update_data["is_flagged"] = True
         if reason:
             update_data["rejection_reason"] = reason
     
-    await db.videos.update_one({"id": video_id}, {"$set": update_data})
+    previous = await db.videos.find_one_and_update(
+        {"id": video_id}, {"$set": update_data},
+        projection={"_id": 0, "user_id": 1, "moderation_status": 1}, return_document=ReturnDocument.BEFORE
+    )
+    if previous and (previous["moderation_status"] == "approved") != (status == "approved"):
+        await db.users.update_one({"id": previous["user_id"]},
+                                  {"$inc": {"stats.video_count": 1 if status == "approved" else -1}})
+    await invalidation_bus.publish("search.video_status", {"video_id": video_id, "status": status})
     return {"message": f"Video {status}", "video_id": video_id}
 
 @api_router.get("/admin/users")
@@ -355,12 +2153,14 @@ async def ban_user(user_id: str, ban_data: dict, admin: bool = Depends(get_admin
     
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    await revocations.revoke_user(db, user_id)
     
     # Also reject all pending videos from this user
     await db.videos.update_many(
         {"user_id": user_id, "moderation_status": "pending"},
         {"$set": {"moderation_status": "rejected", "is_flagged": True}}
     )
+    await invalidation_bus.publish("search.user_status", {"user_id": user_id, "from_status": "pending", "to_status": "rejected"})
     
     return {"message": "User banned successfully"}
 
@@ -378,33 +2178,56 @@ async def unban_user(user_id: str, admin: bool = Depends(get_admin_user)):
 
 @api_router.delete("/admin/videos/{video_id}")
 async def delete_video(video_id: str, admin: bool = Depends(get_admin_user)):
-    result = await db.videos.delete_one({"id": video_id})
-    if result.deleted_count == 0:
+    video = await db.videos.find_one_and_delete(
+        {"id": video_id}, projection={"_id": 0, "user_id": 1, "views": 1, "likes": 1, "moderation_status": 1}
+    )
+    if video is None:
         raise HTTPException(status_code=404, detail="Video not found")
     
+    # Take the video out of its creator's profile stats
+    await db.users.update_one({"id": video["user_id"]}, {"$inc": {
+        "stats.video_count": -1 if video.get("moderation_status") == "approved" else 0,
+        "stats.total_views": -(video.get("views", 0) + view_counter.get(video_id)),
+        "stats.total_likes": -video.get("likes", 0),
+    }})
+    
     # Also delete associated comments and likes
     await db.comments.delete_many({"video_id": video_id})
     await db.likes.delete_many({"video_id": video_id})
+    await db.hls_segments.delete_many({"video_id": video_id})
+    view_counter.discard(video_id)
+    await invalidation_bus.publish("search.video_removed", {"video_id": video_id})
     
     return {"message": "Video deleted successfully"}
 
 @api_router.delete("/admin/comments/{comment_id}")
-async def delete_comment(comment_id: str, admin: bool = Depends(get_admin_user)):
-    result = await db.comments.delete_one({"id": comment_id})
-    if result.deleted_count == 0:
+async def delete_comment(comment_id: str, video_id: Optional[str] = None, admin: bool = Depends(get_admin_user)):
+    # Comments are sharded by video_id; callers that know it avoid a scatter-gather lookup
+    if video_id is None:
+        located = await db.comments.find_one({"id": comment_id}, {"_id": 0, "video_id": 1})
+        if located is None:
+            raise HTTPException(status_code=404, detail="Comment not found")
+        video_id = located["video_id"]
+    comment = await db.comments.find_one_and_delete({"video_id": video_id, "id": comment_id},
+                                                    projection={"_id": 0, "moderation_status": 1})
+    if comment is None:
         raise HTTPException(status_code=404, detail="Comment not found")
+    # Rejected comments were already taken off the count when the classifier rejected them
+    if comment.get("moderation_status") != "rejected":
+        await db.videos.update_one({"id": video_id}, {"$inc": {"comment_count": -1}})
+    await invalidation_bus.publish("search.comment_removed", {"comment_id": comment_id})
     
     return {"message": "Comment deleted successfully"}
 
 # Stats endpoint for admin
 @api_router.get("/admin/stats")
 async def get_admin_stats(admin: bool = Depends(get_admin_user)):
-    total_users = await db.users.count_documents({})
-    banned_users = await db.users.count_documents({"is_banned": True})
-    total_videos = await db.videos.count_documents({})
-    flagged_videos = await db.videos.count_documents({"is_flagged": True})
-    pending_videos = await db.videos.count_documents({"moderation_status": "pending"})
-    total_comments = await db.comments.count_documents({})
+    total_users = await read_db.users.count_documents({})
+    banned_users = await read_db.users.count_documents({"is_banned": True})
+    total_videos = await read_db.videos.count_documents({})
+    flagged_videos = await read_db.videos.count_documents({"is_flagged": True})
+    pending_videos = await read_db.videos.count_documents({"moderation_status": "pending"})
+    total_comments = await read_db.comments.count_documents({})
     
     return {
         "total_users": total_users,
@@ -415,9 +2238,37 @@ async def get_admin_stats(admin: bool = Depends(get_admin_user)):
         "total_comments": total_comments
     }
 
+@api_router.get("/admin/metrics")
+async def get_admin_metrics(admin: bool = Depends(get_admin_user)):
+    return {"db_pool": pool_metrics.snapshot(),
+            "moderation": {**moderation_pipeline.stats, "queued": moderation_pipeline.queue.qsize()},
+            "cpu_offload": cpu_offloader.snapshot(),
+            "invalidation_bus": {"type": INVALIDATION_BUS, "origin": invalidation_bus.origin, **invalidation_bus.stats}}
+
+@api_router.get("/admin/profiles")
+async def list_profiles(admin: bool = Depends(get_admin_user)):
+    if not PROFILING_DIR.exists():
+        return []
+    files = sorted(PROFILING_DIR.glob("*.json"), reverse=True)
+    return [{"name": f.name, "size": f.stat().st_size} for f in files]
+
+@api_router.get("/admin/profiles/{name}")
+async def download_profile(name: str, admin: bool = Depends(get_admin_user)):
+    path = PROFILING_DIR / name
+    if not PROFILE_NAME_PATTERN.match(name) or not path.exists():
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, media_type="application/json", filename=name)
+
 # Include router
 app.include_router(api_router)
 
+@app.exception_handler(WaitQueueTimeoutError)
+@app.exception_handler(ServerSelectionTimeoutError)
+async def database_unavailable_handler(request, exc):
+    logger.warning("Database unavailable for %s: %s", request.url.path, exc)
+    return JSONResponse(status_code=503, content={"detail": "Database temporarily unavailable"},
+                        headers={"Retry-After": "1"})
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -431,6 +2282,248 @@ app.add_middleware(
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+# Lifecycle
+STARTUP_DB_RETRIES = int(os.environ.get('STARTUP_DB_RETRIES', 5))
+# How long /readyz reports "draining" after SIGTERM before uvicorn stops accepting connections.
+# Off by default: the delay must fit inside the supervisor's kill grace period (supervisord
+# stopwaitsecs, Kubernetes terminationGracePeriodSeconds) together with request draining and
+# the final counter flush, and `uvicorn --reload` stops its workers with SIGTERM too.
+SHUTDOWN_UNREADY_SECONDS = float(os.environ.get('SHUTDOWN_UNREADY_SECONDS', 0))
+COUNTER_FLUSH_INTERVAL_SECONDS = float(os.environ.get('COUNTER_FLUSH_INTERVAL_SECONDS', 5))
+
+class Lifecycle:
+    def __init__(self):
+        self.ready = False
+        self.draining = False
+        self.stopping = asyncio.Event()
+        self.drain_timer = None
+        self.flush_task = None
+        self.revocation_task = None
+        self.hls_requeue_task = None
+
+lifecycle = Lifecycle()
+
+def begin_draining():
+    """SIGTERM handler: fail readiness first, then hand over to uvicorn's shutdown.
+
+    uvicorn closes its listeners and waits for open requests as soon as it handles
+    the signal, before the lifespan shutdown runs, so the worker has to go unready
+    here for load balancers to stop routing to it while it is still serving.
+    """
+    if lifecycle.draining:
+        # A second SIGTERM skips the wait, like uvicorn's own double signal
+        lifecycle.drain_timer.cancel()
+        signal.raise_signal(signal.SIGINT)
+        return
+    lifecycle.ready = False
+    lifecycle.draining = True
+    logger.info("SIGTERM received, draining for %.1fs before shutdown", SHUTDOWN_UNREADY_SECONDS)
+    # uvicorn handles SIGINT and SIGTERM the same way; SIGINT is left untouched
+    lifecycle.drain_timer = asyncio.get_running_loop().call_later(
+        SHUTDOWN_UNREADY_SECONDS, signal.raise_signal, signal.SIGINT
+    )
+
+def install_drain_handler():
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, begin_draining)
+    except (NotImplementedError, RuntimeError, ValueError) as e:
+        # Not on the main thread (test clients) or the loop has no signal support
+        logger.info("Not installing SIGTERM drain handler: %s", e)
+
+def can_force_profile(request: Request, header: str) -> bool:
+    """Forced profiles run the stack sampler and write to disk, so anonymous clients can't ask for them"""
+    if PROFILING_HEADER_TOKEN is not None and hmac.compare_digest(header, PROFILING_HEADER_TOKEN):
+        return True
+    scheme, _, credentials = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not credentials:
+        return False
+    try:
+        payload = decode_token(credentials)
+    except jwt.PyJWTError:
+        return False
+    return payload.get("type") == "admin" and not revocations.is_revoked(payload)
+
+def should_profile(request: Request) -> Optional[bool]:
+    """None to skip profiling, otherwise whether the profile was forced by header"""
+    header = request.headers.get(PROFILING_HEADER)
+    if header is not None and can_force_profile(request, header):
+        return True
+    if random.random() < PROFILING_SAMPLE_RATE:
+        return False
+    return None
+
+class ProfilingMiddleware:
+    """Pure ASGI middleware, so requests that aren't sampled go straight to the app"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request = Request(scope)
+        forced = should_profile(request)
+        if forced is None:
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(request.method, request.url.path, forced)
+        token = current_profile.set(profile)
+        stack_sampler.add(profile)
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            finished = time.perf_counter()
+            stack_sampler.remove(profile)
+            current_profile.reset(token)
+            duration_ms = (finished - started) * 1000
+            if profile.endpoint_started is not None and profile.endpoint_finished is not None:
+                profile.add_span("dependencies", (profile.endpoint_started - started) * 1000)
+                profile.add_span("endpoint", (profile.endpoint_finished - profile.endpoint_started) * 1000)
+                profile.add_span("serialization", (finished - profile.endpoint_finished) * 1000)
+            if forced or duration_ms >= PROFILING_SLOW_MS:
+                try:
+                    name = await asyncio.to_thread(write_profile, profile.to_dict(duration_ms, status_code))
+                    logger.info("Profiled %s %s in %.1fms: %s", request.method, request.url.path, duration_ms, name)
+                except OSError as e:
+                    logger.error("Failed to write request profile: %s", e)
+
+# Only registered when enabled so requests don't pay for the middleware otherwise
+if PROFILING_ENABLED:
+    app.add_middleware(ProfilingMiddleware)
+
+async def wait_for_database():
+    for attempt in range(1, STARTUP_DB_RETRIES + 1):
+        try:
+            await client.admin.command("ping")
+            return
+        except Exception as e:
+            if attempt == STARTUP_DB_RETRIES:
+                raise
+            logger.warning("MongoDB not reachable (attempt %d/%d): %s", attempt, STARTUP_DB_RETRIES, e)
+            await asyncio.sleep(min(2 ** attempt * 0.25, 5))
+
+TOKEN_REVOCATION_INDEX = "token_revocation_value"
+
+async def dedupe_token_revocations():
+    """Remove duplicate token revocations written before they were unique, so the index can be built"""
+    duplicates = db.revocations.aggregate([
+        {"$match": {"kind": "token"}},
+        {"$group": {"_id": "$value", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ])
+    async for group in duplicates:
+        await db.revocations.delete_many({"_id": {"$in": group["ids"][1:]}})
+
+async def ensure_indexes():
+    await db.users.create_index("id")
+    await db.users.create_index("email")
+    await db.users.create_index("username")
+    await db.videos.create_index("id")
+    await db.videos.create_index([("moderation_status", 1), ("created_at", -1)])
+    await db.videos.create_index([("user_id", 1), ("moderation_status", 1), ("created_at", -1), ("id", -1)],
+                                 name=PROFILE_PAGE_INDEX)
+    await db.comments.create_index("id")
+    await db.comments.create_index([("video_id", 1), ("created_at", -1)])
+    await db.likes.create_index([("video_id", 1), ("user_id", 1)])
+    await db.hls_segments.create_index([("video_id", 1), ("path", 1)])
+    await db.videos.create_index([("hls_status", 1), ("hls_lease_until", 1)])
+    await db.revocations.create_index("created_at")
+    await dedupe_token_revocations()
+    await db.revocations.create_index("value", unique=True, partialFilterExpression={"kind": "token"},
+                                      name=TOKEN_REVOCATION_INDEX)
+    await db.moderation_verdicts.create_index("hash")
+    await db.revocations.create_index("expires_at", expireAfterSeconds=0)
+
+async def flush_counters():
+    try:
+        await view_counter.flush(db)
+        await user_view_counter.flush(db)
+    except Exception as e:
+        logger.error("Failed to flush buffered counters: %s", e)
+
+async def sync_revocations_periodically():
+    while True:
+        await asyncio.sleep(REVOCATION_SYNC_SECONDS)
+        try:
+            await revocations.sync(db)
+        except Exception as e:
+            logger.error("Failed to sync token revocations: %s", e)
+
+async def flush_counters_periodically():
+    # Stopped with an event rather than cancelled so a flush is never cut off mid-write
+    while not lifecycle.stopping.is_set():
+        try:
+            await asyncio.wait_for(lifecycle.stopping.wait(), timeout=COUNTER_FLUSH_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            await flush_counters()
+
+async def startup():
+    await wait_for_database()
+    await ensure_indexes()
+    await ensure_sharding()
+    await backfill_comment_counts()
+    await backfill_user_stats()
+    # Subscribe before the initial loads so no event is lost between loading and tailing
+    await invalidation_bus.start()
+    await revocations.sync(db)
+    lifecycle.revocation_task = asyncio.create_task(sync_revocations_periodically())
+    await rebuild_search_index()
+    logger.info("Search index built: %d videos, %d terms", len(search_index.videos), len(search_index.postings))
+    lifecycle.flush_task = asyncio.create_task(flush_counters_periodically())
+    await cpu_offloader.warm_up()
+    await reconcile_hls_status()
+    await requeue_hls_jobs()
+    lifecycle.hls_requeue_task = asyncio.create_task(requeue_hls_jobs_periodically())
+    moderation_pipeline.start()
+    await requeue_pending_moderation()
+    if SHUTDOWN_UNREADY_SECONDS > 0:
+        install_drain_handler()
+    lifecycle.ready = True
+
+async def shutdown():
+    # uvicorn has already stopped serving and waited for open requests by now
+    lifecycle.ready = False
+    lifecycle.draining = True
+    lifecycle.stopping.set()
+    if lifecycle.flush_task:
+        await lifecycle.flush_task
+    if lifecycle.revocation_task:
+        lifecycle.revocation_task.cancel()
+    if lifecycle.hls_requeue_task:
+        lifecycle.hls_requeue_task.cancel()
+    await moderation_pipeline.stop()
+    # Interrupted jobs release their lease; another worker or the next startup resumes them
+    pending_jobs = list(hls_jobs)
+    for task in pending_jobs:
+        task.cancel()
+    await asyncio.gather(*pending_jobs, return_exceptions=True)
+    await flush_counters()
+    await invalidation_bus.stop()
+    cpu_offloader.shutdown()
+    client.close()
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    if not lifecycle.ready:
+        status = "draining" if lifecycle.draining else "starting"
+        return JSONResponse(status_code=503, content={"status": status})
+    try:
+        await asyncio.wait_for(client.admin.command("ping"), timeout=1)
+    except Exception:
+        return JSONResponse(status_code=503, content={"status": "database unavailable"})
+    return {"status": "ready"}
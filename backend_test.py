@@ -43,6 +43,9 @@ admin_token = None
 test_video_id = None
 test_comment_id = None
 
+# A one-second 320x240 H.264 clip, small enough to package quickly
+SAMPLE_VIDEO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests", "fixtures", "sample.mp4")
+
 def print_test_result(test_name, success, message=""):
     """Print formatted test results"""
     status = "✅ PASS" if success else "❌ FAIL"
@@ -57,6 +60,21 @@ def create_test_video_data():
     test_content = b"FAKE_VIDEO_DATA_FOR_TESTING_PURPOSES_ONLY"
     return base64.b64encode(test_content).decode('utf-8')
 
+def test_health_probes():
+    """Test liveness and readiness probes"""
+    print("=== Testing Health Probes ===")
+    
+    base_url = BACKEND_URL.rsplit("/api", 1)[0]
+    for probe in ["healthz", "readyz"]:
+        try:
+            response = requests.get(f"{base_url}/{probe}")
+            if response.status_code == 200:
+                print_test_result(f"Probe /{probe}", True, f"Status: {response.json()['status']}")
+            else:
+                print_test_result(f"Probe /{probe}", False, f"Status: {response.status_code}, Response: {response.text}")
+        except Exception as e:
+            print_test_result(f"Probe /{probe}", False, f"Exception: {str(e)}")
+
 def test_user_registration():
     """Test user registration functionality"""
     global user1_token, user2_token
@@ -110,12 +128,25 @@ def test_user_login():
         if response.status_code == 200:
             data = response.json()
             user1_token = data.get("access_token")  # Update token
+            user1_refresh_token = data.get("refresh_token")
             print_test_result("Valid User Login", True, f"Login successful for {data['user']['username']}")
         else:
             print_test_result("Valid User Login", False, f"Status: {response.status_code}, Response: {response.text}")
     except Exception as e:
         print_test_result("Valid User Login", False, f"Exception: {str(e)}")
     
+    # Test token refresh (refresh tokens are single use)
+    try:
+        response = requests.post(f"{BACKEND_URL}/token/refresh", json={"refresh_token": user1_refresh_token})
+        reused = requests.post(f"{BACKEND_URL}/token/refresh", json={"refresh_token": user1_refresh_token})
+        if response.status_code == 200 and reused.status_code == 401:
+            user1_token = response.json().get("access_token")
+            print_test_result("Token Refresh", True, "Refresh token exchanged once and rejected on reuse")
+        else:
+            print_test_result("Token Refresh", False, f"Status: {response.status_code}, reuse status: {reused.status_code}")
+    except Exception as e:
+        print_test_result("Token Refresh", False, f"Exception: {str(e)}")
+    
     # Test invalid credentials
     try:
         login_data = {"email": TEST_USER_1["email"], "password": "wrongpassword"}
@@ -248,6 +279,17 @@ def test_content_moderation():
             print_test_result("Banned User Login Block", False, f"Should have failed with 403, got {response.status_code}")
     except Exception as e:
         print_test_result("Banned User Login Block", False, f"Exception: {str(e)}")
+    
+    # Test that the banned user's existing token stops working
+    try:
+        headers = {"Authorization": f"Bearer {user2_token}"}
+        response = requests.get(f"{BACKEND_URL}/videos/any-video/like-status", headers=headers)
+        if response.status_code == 403:
+            print_test_result("Banned User Token Revoked", True, "Correctly rejected token issued before the ban")
+        else:
+            print_test_result("Banned User Token Revoked", False, f"Should have failed with 403, got {response.status_code}")
+    except Exception as e:
+        print_test_result("Banned User Token Revoked", False, f"Exception: {str(e)}")
 
 def test_video_retrieval():
     """Test video retrieval functionality"""
@@ -276,6 +318,136 @@ def test_video_retrieval():
         except Exception as e:
             print_test_result("Get Specific Video", False, f"Exception: {str(e)}")
 
+    # Test async classifier stage (passes the keyword check, rejected shortly after)
+    if test_video_id:
+        headers = {"Authorization": f"Bearer {user1_token}"}
+        try:
+            comment_data = {"content": "Buy followers here, click here for free money"}
+            response = requests.post(f"{BACKEND_URL}/videos/{test_video_id}/comments", 
+                                   headers=headers, json=comment_data)
+            time.sleep(1)
+            comments = requests.get(f"{BACKEND_URL}/videos/{test_video_id}/comments").json()
+            if response.status_code == 200 and all(c["content"] != comment_data["content"] for c in comments):
+                print_test_result("Async Comment Moderation", True, "Classifier rejected spam comment after posting")
+            else:
+                print_test_result("Async Comment Moderation", False, f"Status: {response.status_code}, comment still visible")
+        except Exception as e:
+            print_test_result("Async Comment Moderation", False, f"Exception: {str(e)}")
+
+def test_search():
+    """Test full-text search over videos and comments"""
+    print("=== Testing Search ===")
+    
+    # Test prefix search over titles finds the uploaded video (it may still be awaiting classification)
+    try:
+        found = False
+        for _ in range(10):
+            response = requests.get(f"{BACKEND_URL}/search", params={"q": "amaz", "limit": 50})
+            if response.status_code != 200:
+                break
+            data = response.json()
+            found = any(result["video"]["id"] == test_video_id for result in data["results"])
+            if found:
+                break
+            time.sleep(1)
+        if found:
+            print_test_result("Search Videos", True, f"Found the uploaded video among {len(data['results'])} results")
+        else:
+            print_test_result("Search Videos", False, f"Status: {response.status_code}, uploaded video {test_video_id} not in results")
+    except Exception as e:
+        print_test_result("Search Videos", False, f"Exception: {str(e)}")
+    
+    # Test that non-approved results require admin access
+    try:
+        response = requests.get(f"{BACKEND_URL}/search", params={"q": "video", "status": "rejected"})
+        if response.status_code == 401:
+            print_test_result("Search Status Filter Access Control", True, "Correctly blocked anonymous rejected-video search")
+        else:
+            print_test_result("Search Status Filter Access Control", False, f"Should have failed with 401, got {response.status_code}")
+    except Exception as e:
+        print_test_result("Search Status Filter Access Control", False, f"Exception: {str(e)}")
+
+    # Test HLS packaging end to end with a real (tiny) video
+    if user1_token:
+        try:
+            headers = {"Authorization": f"Bearer {user1_token}"}
+            with open(SAMPLE_VIDEO_PATH, "rb") as sample:
+                files = {'file': ('sample.mp4', sample.read(), 'video/mp4')}
+            response = requests.post(f"{BACKEND_URL}/videos", headers=headers, files=files,
+                                     data={"title": "HLS sample", "description": "Test pattern"})
+            video_id = response.json()["video"]["id"]
+            hls_status = "pending"
+            for _ in range(60):
+                hls_status = requests.get(f"{BACKEND_URL}/videos/{video_id}").json()["hls_status"]
+                if hls_status != "pending":
+                    break
+                time.sleep(1)
+            master = requests.get(f"{BACKEND_URL}/videos/{video_id}/hls/master.m3u8")
+            variants = [line for line in master.text.splitlines() if line and not line.startswith("#")]
+            playlist = requests.get(f"{BACKEND_URL}/videos/{video_id}/hls/{variants[0]}") if variants else None
+            segments = [line for line in playlist.text.splitlines() if line.endswith(".ts")] if playlist else []
+            segment = None
+            if segments:
+                rendition = variants[0].split("/")[0]
+                segment = requests.get(f"{BACKEND_URL}/videos/{video_id}/hls/{rendition}/{segments[0]}")
+            if (hls_status == "ready" and master.status_code == 200 and "#EXT-X-STREAM-INF" in master.text
+                    and segment is not None and segment.status_code == 200
+                    and segment.headers.get("Content-Type") == "video/mp2t"):
+                print_test_result("HLS Packaging", True, f"{len(variants)} renditions, first segment {len(segment.content)} bytes")
+            else:
+                print_test_result("HLS Packaging", False, f"hls_status: {hls_status}, master playlist status: {master.status_code}")
+        except Exception as e:
+            print_test_result("HLS Packaging", False, f"Exception: {str(e)}")
+    
+    # Test original file download with byte ranges (fallback when there are no renditions)
+    if test_video_id:
+        try:
+            response = requests.get(f"{BACKEND_URL}/videos/{test_video_id}/file", headers={"Range": "bytes=0-3"})
+            if response.status_code == 206 and len(response.content) == 4:
+                print_test_result("Video File Range Request", True, f"Content-Range: {response.headers.get('Content-Range')}")
+            else:
+                print_test_result("Video File Range Request", False, f"Status: {response.status_code}, Response: {response.text}")
+        except Exception as e:
+            print_test_result("Video File Range Request", False, f"Exception: {str(e)}")
+
+def test_user_profile():
+    """Test creator profile stats and upload history"""
+    print("=== Testing User Profile ===")
+    
+    if not user1_token:
+        print_test_result("User Profile", False, "No user token available")
+        return
+    
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(user1_token.split('.')[1] + "=="))
+        user_id = payload["sub"]
+    except Exception as e:
+        print_test_result("User Profile", False, f"Could not read user id from token: {str(e)}")
+        return
+    
+    # Test profile stats
+    try:
+        response = requests.get(f"{BACKEND_URL}/users/{user_id}/profile")
+        if response.status_code == 200:
+            profile = response.json()
+            print_test_result("Get User Profile", True, f"Stats: {profile['stats']}")
+        else:
+            print_test_result("Get User Profile", False, f"Status: {response.status_code}, Response: {response.text}")
+    except Exception as e:
+        print_test_result("Get User Profile", False, f"Exception: {str(e)}")
+    
+    # Test upload history pagination
+    try:
+        response = requests.get(f"{BACKEND_URL}/users/{user_id}/videos", params={"limit": 10})
+        if response.status_code == 200:
+            data = response.json()
+            has_media = any("file_data" in video for video in data["videos"])
+            print_test_result("Get User Videos", not has_media, f"Retrieved {len(data['videos'])} videos without media bytes")
+        else:
+            print_test_result("Get User Videos", False, f"Status: {response.status_code}, Response: {response.text}")
+    except Exception as e:
+        print_test_result("Get User Videos", False, f"Exception: {str(e)}")
+
 def test_like_system():
     """Test like/unlike functionality"""
     print("=== Testing Like System ===")
@@ -356,6 +528,18 @@ def test_comment_system():
     except Exception as e:
         print_test_result("Get Comments", False, f"Exception: {str(e)}")
     
+    # Test batched comment previews for a feed page
+    try:
+        response = requests.get(f"{BACKEND_URL}/comments/batch", params={"video_ids": test_video_id, "limit": 3})
+        if response.status_code == 200:
+            data = response.json()
+            preview = data.get(test_video_id, {})
+            print_test_result("Batched Comment Previews", True, f"Comment count: {preview.get('comment_count')}, preview size: {len(preview.get('comments', []))}")
+        else:
+            print_test_result("Batched Comment Previews", False, f"Status: {response.status_code}, Response: {response.text}")
+    except Exception as e:
+        print_test_result("Batched Comment Previews", False, f"Exception: {str(e)}")
+    
     # Test inappropriate comment (should be rejected)
     try:
         comment_data = {"content": "This video contains adult content and violence"}
@@ -389,6 +573,28 @@ def test_admin_panel_apis():
     except Exception as e:
         print_test_result("Get Admin Stats", False, f"Exception: {str(e)}")
     
+    # Test database pool metrics
+    try:
+        response = requests.get(f"{BACKEND_URL}/admin/metrics", headers=headers)
+        if response.status_code == 200:
+            metrics = response.json()
+            print_test_result("Get Admin Metrics", True,
+                              f"DB pool: {metrics['db_pool']}, invalidation bus: {metrics['invalidation_bus']}")
+        else:
+            print_test_result("Get Admin Metrics", False, f"Status: {response.status_code}, Response: {response.text}")
+    except Exception as e:
+        print_test_result("Get Admin Metrics", False, f"Exception: {str(e)}")
+    
+    # Test request profile listing
+    try:
+        response = requests.get(f"{BACKEND_URL}/admin/profiles", headers=headers)
+        if response.status_code == 200:
+            print_test_result("List Request Profiles", True, f"{len(response.json())} profiles in ring buffer")
+        else:
+            print_test_result("List Request Profiles", False, f"Status: {response.status_code}, Response: {response.text}")
+    except Exception as e:
+        print_test_result("List Request Profiles", False, f"Exception: {str(e)}")
+    
     # Test getting all users
     try:
         response = requests.get(f"{BACKEND_URL}/admin/users", headers=headers)
@@ -452,14 +658,17 @@ def run_all_tests():
     start_time = time.time()
     
     # Run tests in logical order
+    test_health_probes()
     test_user_registration()
     test_user_login()
     test_admin_authentication()
     test_video_upload()
     test_content_moderation()
     test_video_retrieval()
+    test_user_profile()
     test_like_system()
     test_comment_system()
+    test_search()
     test_admin_panel_apis()
     test_admin_access_control()
     
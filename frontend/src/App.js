@@ -1,4 +1,4 @@
-import React, { useState, useEffect, createContext, useContext } from 'react';
+import React, { useState, useEffect, useRef, createContext, useContext } from 'react';
 import './App.css';
 import axios from 'axios';
 
@@ -36,10 +36,67 @@ const AuthProvider = ({ children }) => {
     }
   }, [token]);
 
-  const login = (tokenData, userData = null) => {
+  // Access tokens are short-lived: on a 401, exchange the refresh token and retry.
+  // Refresh tokens are single-use, so concurrent 401s share one in-flight refresh.
+  useEffect(() => {
+    let refreshing = null;
+
+    const refreshAccessToken = () => {
+      if (!refreshing) {
+        const refreshToken = localStorage.getItem('refresh_token');
+        refreshing = axios.post(`${API}/token/refresh`, { refresh_token: refreshToken })
+          .then((response) => {
+            localStorage.setItem('token', response.data.access_token);
+            localStorage.setItem('refresh_token', response.data.refresh_token);
+            axios.defaults.headers.common['Authorization'] = `Bearer ${response.data.access_token}`;
+            setToken(response.data.access_token);
+            return response.data.access_token;
+          })
+          .catch((refreshError) => {
+            logout();
+            throw refreshError;
+          })
+          .finally(() => {
+            refreshing = null;
+          });
+      }
+      return refreshing;
+    };
+
+    const interceptor = axios.interceptors.response.use(
+      (response) => response,
+      async (error) => {
+        const original = error.config;
+        if (error.response?.status !== 401 || !localStorage.getItem('refresh_token') || original._retried || original.url.endsWith('/token/refresh')) {
+          return Promise.reject(error);
+        }
+        original._retried = true;
+        try {
+          // A refresh may already have finished since this request went out
+          const current = localStorage.getItem('token');
+          if (!current) {
+            return Promise.reject(error);
+          }
+          const accessToken = original.headers['Authorization'] !== `Bearer ${current}`
+            ? current
+            : await refreshAccessToken();
+          original.headers['Authorization'] = `Bearer ${accessToken}`;
+          return axios(original);
+        } catch (refreshError) {
+          return Promise.reject(error);
+        }
+      }
+    );
+    return () => axios.interceptors.response.eject(interceptor);
+  }, []);
+
+  const login = (tokenData, userData = null, refreshToken = null) => {
     setToken(tokenData);
     localStorage.setItem('token', tokenData);
     axios.defaults.headers.common['Authorization'] = `Bearer ${tokenData}`;
+    if (refreshToken) {
+      localStorage.setItem('refresh_token', refreshToken);
+    }
     
     if (userData) {
       setUser(userData);
@@ -47,19 +104,27 @@ const AuthProvider = ({ children }) => {
     }
   };
 
-  const loginAdmin = (tokenData) => {
+  const loginAdmin = (tokenData, refreshToken = null) => {
     setToken(tokenData);
     setIsAdmin(true);
     localStorage.setItem('token', tokenData);
     axios.defaults.headers.common['Authorization'] = `Bearer ${tokenData}`;
+    if (refreshToken) {
+      localStorage.setItem('refresh_token', refreshToken);
+    }
   };
 
   const logout = () => {
+    const refreshToken = localStorage.getItem('refresh_token');
+    if (axios.defaults.headers.common['Authorization']) {
+      axios.post(`${API}/logout`, { refresh_token: refreshToken }).catch(() => {});
+    }
     setUser(null);
     setIsAdmin(false);
     setToken(null);
     localStorage.removeItem('token');
     localStorage.removeItem('user');
+    localStorage.removeItem('refresh_token');
     delete axios.defaults.headers.common['Authorization'];
   };
 
@@ -79,6 +144,53 @@ const useAuth = () => {
 };
 
 // Components
+// Streams the HLS ladder once the video has been packaged, otherwise the original upload
+const VideoPlayer = ({ video, className }) => {
+  const videoRef = useRef(null);
+
+  useEffect(() => {
+    const element = videoRef.current;
+    const fileUrl = `${API}/videos/${video.id}/file`;
+    const masterUrl = `${API}/videos/${video.id}/hls/master.m3u8`;
+    if (video.hls_status !== 'ready') {
+      element.src = fileUrl;
+      return undefined;
+    }
+    if (element.canPlayType('application/vnd.apple.mpegurl')) {
+      // Safari plays HLS natively
+      element.src = masterUrl;
+      return undefined;
+    }
+
+    let hls = null;
+    let cancelled = false;
+    import('hls.js')
+      .then(({ default: Hls }) => {
+        if (cancelled) return;
+        if (!Hls.isSupported()) {
+          element.src = fileUrl;
+          return;
+        }
+        hls = new Hls();
+        hls.loadSource(masterUrl);
+        hls.attachMedia(element);
+      })
+      .catch(() => {
+        if (!cancelled) element.src = fileUrl;
+      });
+    return () => {
+      cancelled = true;
+      if (hls) hls.destroy();
+    };
+  }, [video.id, video.hls_status]);
+
+  return (
+    <video ref={videoRef} controls className={className}>
+      Your browser does not support video playback.
+    </video>
+  );
+};
+
 const Navbar = ({ currentPage, setCurrentPage }) => {
   const { user, isAdmin, logout } = useAuth();
 
@@ -285,13 +397,7 @@ const Home = () => {
           
           <div className="bg-white rounded-lg shadow-md overflow-hidden">
             <div className="aspect-video bg-black flex items-center justify-center">
-              <video 
-                controls 
-                className="w-full h-full"
-                src={`data:video/mp4;base64,${selectedVideo.file_data}`}
-              >
-                Your browser does not support video playback.
-              </video>
+              <VideoPlayer video={selectedVideo} className="w-full h-full" />
             </div>
             
             <div className="p-6">
@@ -407,9 +513,11 @@ const Home = () => {
                   className="aspect-video bg-black flex items-center justify-center"
                   onClick={() => openVideo(video)}
                 >
+                  {/* Preview frame only: metadata is fetched with a range request, not the whole file */}
                   <video 
                     className="w-full h-full object-cover"
-                    src={`data:video/mp4;base64,${video.file_data}`}
+                    src={`${API}/videos/${video.id}/file#t=0.1`}
+                    preload="metadata"
                     muted
                   >
                     Your browser does not support video playback.
@@ -604,7 +712,7 @@ const Login = () => {
 
     try {
       const response = await axios.post(`${API}/login`, { email, password });
-      login(response.data.access_token, response.data.user);
+      login(response.data.access_token, response.data.user, response.data.refresh_token);
       
     } catch (error) {
       alert(error.response?.data?.detail || 'Login failed');
@@ -671,7 +779,7 @@ const Register = () => {
 
     try {
       const response = await axios.post(`${API}/register`, { username, email, password });
-      login(response.data.access_token, response.data.user);
+      login(response.data.access_token, response.data.user, response.data.refresh_token);
       
     } catch (error) {
       alert(error.response?.data?.detail || 'Registration failed');
@@ -751,7 +859,7 @@ const AdminLogin = () => {
 
     try {
       const response = await axios.post(`${API}/admin/login`, { username, password });
-      loginAdmin(response.data.access_token);
+      loginAdmin(response.data.access_token, response.data.refresh_token);
       
     } catch (error) {
       alert(error.response?.data?.detail || 'Admin login failed');